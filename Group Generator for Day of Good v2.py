@@ -5,8 +5,23 @@
 # IMPORTS ----------------------------------------------------------------------------------
 
 # NOTE on pandas for new users: If assigning, you need to use df.at[i, j] or df.loc[i, j] instead of just df[i, j], due to https://pandas.pydata.org/pandas-docs/stable/user_guide/indexing.html#returning-a-view-versus-a-copy. .at is preferred for single variable assigning
+import numpy as np
 import pandas as pd
-from collections import defaultdict, Counter
+import cProfile
+import difflib
+import builtins
+import hashlib
+import io
+import json
+import os
+import pickle
+import re
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from itertools import chain
 from pathlib import Path
 
@@ -14,37 +29,54 @@ from pathlib import Path
 
 # These could probably be read from an excel sheet or inputted, if you wanted to make a more easy-to-use interactive wrapper, but I cbs
 PATH = Path(__file__).parent
-PLACES_FILEPATH = PATH.joinpath("places_input.xlsx")
+PLACES_FILEPATH = PATH.joinpath("places_input.xlsx") # The inputs can also be .csv or .parquet files, which are much quicker to read for big events
 SIGNUPS_FILEPATH = PATH.joinpath("signups_input.xlsx")
+INPUT_FORMAT = None # None works out whether the inputs are "xlsx", "csv" or "parquet" from the file extension, or set it to one of those
+OUTPUT_FORMAT = "xlsx" # "xlsx" saves everything to placements_output.xlsx. "csv" or "parquet" saves each sheet as its own file instead, which is much quicker
 MAX_NUM_EMAILS = 3
 MAX_RECURSIONS = 50
+INCREMENTAL = False # Set to True to keep everyone where they were in a previous output, and only place the new signups
+PREVIOUS_PLACEMENTS_FILEPATH = PATH.joinpath("previous_placements_output.xlsx") # Where the previous output is when INCREMENTAL is on
+WRITE_RUN_REPORT = True # Saves how long each step took and what the solver did to placements_report.json, which is handy if a run is slow or leaves lots of people unplaced
+PROFILE_ASSIGNMENT = False # Also saves a cProfile of the placing step to placements_assignment.prof (open it with snakeviz or pstats)
+SOLVER = "heuristic" # "heuristic" is the original place-and-bump approach, "flow" treats it as a max-flow problem and only gives up on a group when it can't find a chain of moves to fit them in
+OPTIMISE_SECONDS = 0 # If this is more than 0, spends this many seconds trying shuffled orders of the places/signups on all CPU cores and keeps the best placement
+OPTIMISE_WORKERS = None # How many CPU cores to use when optimising (None uses all of them)
+OPTIMISE_SEED = 0 # Running with the same seed (and the same inputs) gives the same shuffles, but how many get tried depends on how fast your computer is
+OPTIMISE_TRIAL = None # Set this to the best trial number an optimising run printed (with the same OPTIMISE_SEED) to get exactly that placement again, without searching
+ORDER_NOISE = 0.25 # How much the shuffles can change the sorting values by (0.25 means up to 25% either way), so only places/signups which are close get swapped
+SPLIT_INTO_COMPONENTS = True # Places separate clusters of places (that no group picked across) on their own, and on different CPU cores if they're big
+COMPONENT_WORKERS = None # How many CPU cores to use for big clusters (None uses all of them)
+MIN_PARALLEL_COMPONENT_SIGNUPS = 5000 # Clusters with fewer signups than this aren't worth sending to another CPU core
+RESOLVE_PLACE_NAMES = True # Matches up place names in the signups which are spelled a bit differently to the places input (capitals, spaces, punctuation), and suggests fixes for the rest
+PLACE_ALIASES_FILENAME = "place_aliases.csv" # Saved next to the places input. Put 'yes' in the accepted column for a suggestion and it gets used every time you rerun
+USE_CACHE = True # Saves the inputs after reading and preprocessing them, so rerunning after fixing one file doesn't redo the slow bits for what hasn't changed. Run with --no-cache to skip it
+CACHE_PATH = PATH.joinpath("placement_cache")
+CACHE_MAX_MB = 500 # When the cache gets bigger than this, the files in it that were used least recently get deleted
 
 # PREPROCESSING ---------------------------------------------------------------------------
 
 # Checks for emails that appear multiple times, treats emails as unique IDs.
 # These currently need to be dealt with manually by the user
-def check_repeated_emails(df_signups):
-    line_ids_for_emails = defaultdict(list)
+# All of the preprocessing works on whole columns at once rather than going row by row, since that gets really slow with lots of signups
+def check_repeated_emails(df_signups, max_num_emails = None):
+    # Stack the email columns into one long column (row by row, so it's in the same order as the spreadsheet), and record the line number each came from
+    emails = df_signups[get_email_col_names(max_num_emails)].stack().dropna()
+    emails = emails.astype(str).str.strip().str.lower() # To avoid errors due to different formatting or whitespace
+    line_ids = emails.index.get_level_values(0) + 2 # +2 offset to account for header line
+    df_emails = pd.DataFrame({'email': emails.to_numpy(), 'line_id': line_ids})
+    df_emails = df_emails[df_emails['email'] != "nan"] # For empty cells
 
-    for i in range(len(df_signups)): # Record the line numbers where each email appears
-        for col_name in get_email_col_names():
-            email = str(df_signups.at[i, col_name]).strip().lower() # To avoid errors due to different formatting or whitespace
-            line_ids_for_emails[email].append(i + 2) # +2 offset to account for header line
+    print("There are " + str(df_emails['email'].nunique()) + " unique emails who have signed up")
 
-    if "nan" in line_ids_for_emails.keys():
-        line_ids_for_emails.pop("nan") # For empty cells
-    
-    line_ids_for_emails = line_ids_for_emails.items()
-    print("There are " + str(len(line_ids_for_emails)) + " unique emails who have signed up")
-
-    # Get only the emails which have been repeated
-    repeated_emails = [x for x in line_ids_for_emails if len(x[1]) > 1]
+    # Get only the emails which have been repeated, with the list of lines each one appears on
+    df_emails = df_emails[df_emails['email'].duplicated(keep = False)]
+    repeated_emails = df_emails.groupby('email', sort = False)['line_id'].agg(list)
 
     if len(repeated_emails) > 0:
         print("There are " + str(len(repeated_emails)) + " emails which appear in the signup form multiple times. \nThese may be groups who signed up multiple times (once for each person), or a person who changed their response after submitting. Generally, you can simply delete the earliest instance where they appear, as the later one is probably a resubmission with more accurate details\nPlease see the output excel for a list of these emails and amend before rerunning the code")
         print("\n")
-        repeated_emails = pd.DataFrame(repeated_emails) 
-        repeated_emails.columns = ["email","appears on lines"]
+        repeated_emails = pd.DataFrame({"email": repeated_emails.index, "appears on lines": repeated_emails.to_numpy()})
     else:
         repeated_emails = pd.DataFrame()
 
@@ -53,393 +85,1995 @@ def check_repeated_emails(df_signups):
 # A functions which checks for commas in the names of charities and removes them. It then updates all the signups in df_signups
 # to remove commas in the charity name, so the string of charities they signed up for can be split into a list
 def remove_commas(df_charities, df_signups):
-    charities_with_commas = []
+    charity_names = df_charities['charity']
+    charities_with_commas = charity_names[charity_names.str.contains(',', regex = False)]
+    replacements = dict(zip(charities_with_commas, charities_with_commas.str.replace(',', '', regex = False)))
 
-    for i in range(len(df_charities)):
-        charity_name = df_charities.at[i, 'charity']
-        if ',' in charity_name:
-            charities_with_commas.append([charity_name, charity_name.replace(',', '')])
-            df_charities.at[i, 'charity'] = charity_name.replace(',', '')
+    df_charities['charity'] = charity_names.str.replace(',', '', regex = False)
 
-    for i in range(len(df_signups)):
-        for charity_replacement in charities_with_commas:
-            df_signups.at[i, 'chosen_charities'] = df_signups.at[i, 'chosen_charities'].replace(charity_replacement[0], charity_replacement[1])
+    if len(replacements) > 0:
+        # One pass over the signups, matching any of the names at once. Longest names first, in case one name is part of another
+        pattern = '|'.join(re.escape(charity_name) for charity_name in sorted(replacements, key = len, reverse = True))
+        df_signups['chosen_charities'] = df_signups['chosen_charities'].str.replace(pattern, lambda match: replacements[match.group(0)], regex = True)
 
 
 # Counts the number of participants in each group (line of the dataframe)
-def count_num_participants_in_group(df_signups):
-    # Initialise columns
-    df_signups['num_participants'] = 0
-    df_signups['participant_emails'] = [[] for i in range(len(df_signups))]
-    
-    for i in range(len(df_signups)): # Create a list of participants in line and count length
-        for col_name in get_email_col_names():
-            if type(df_signups[col_name][i]) != float:
-                df_signups.loc[i, 'participant_emails'].append(df_signups[col_name][i])
-        df_signups.loc[i, 'num_participants'] = len(df_signups.loc[i, 'participant_emails'])
+def count_num_participants_in_group(df_signups, max_num_emails = None):
+    df_signups['num_participants'] = df_signups[get_email_col_names(max_num_emails)].notna().sum(axis = 1)
+
+# Everyone's emails as one long array plus where each signup's part of it starts (the same layout as PreferenceLists), taking all the
+# non-empty cells in one go (line by line, in column order). This only gets made when an output needs the emails, rather than keeping a
+# list of emails for every signup in df_signups the whole way through, which takes up a lot of memory with lots of signups
+def get_signup_emails(df_signups, max_num_emails = None):
+    email_cols = df_signups[get_email_col_names(max_num_emails)]
+    has_email = email_cols.notna().to_numpy()
+    offsets = np.concatenate([[0], np.cumsum(has_email.sum(axis = 1))]).astype(np.int64)
+    return PreferenceLists(offsets, email_cols.to_numpy(dtype = object)[has_email])
 
 # Counts how many charities each group chose
+# The names get interned, so every pick of the same place is the same string in memory rather than each signup having its own copy of it
+# (with lots of signups, that's most of the memory the signups take up)
 def count_charities_picked_by_group(df_signups):
-    # Initialise columns
-    df_signups['num_charities_picked'] = 0
-    df_signups['charity_list'] = [[] for i in range(len(df_signups))]
+    charity_lists = [[sys.intern(name) for name in chosen_charities.split(', ')] if isinstance(chosen_charities, str) else [''] for chosen_charities in df_signups['chosen_charities'].tolist()]
+    df_signups['charity_list'] = pd.Series(charity_lists, index = df_signups.index, dtype = object) # Still lists (not floats) with no signups
+    df_signups['num_charities_picked'] = np.fromiter(map(len, charity_lists), dtype = np.int64, count = len(charity_lists))
 
-    for i in range(len(df_signups)):
-        df_signups.at[i, 'charity_list'] = df_signups.at[i, 'chosen_charities'].split(', ')
-        df_signups.at[i, 'num_charities_picked'] = len(df_signups.loc[i, 'charity_list'])
 
+def count_num_time_charity_picked(df_charities, df_signups, places_filepath = PLACES_FILEPATH):
+    # Get the counts of each time a charity appears, in the order they first appear
+    all_charities_picked = df_signups['charity_list'].explode()
+    charity_counts = all_charities_picked.groupby(all_charities_picked, sort = False).size()
 
-def count_num_time_charity_picked(df_charities, df_signups):
-    # Get the counts of each time a charity appears
-    all_charities_picked = df_signups['charity_list']
-    charity_counts = Counter(chain(*list(all_charities_picked)))
+    # If a charity is somehow in the input file twice, only the first one gets the signups
+    total_signups = df_charities['charity'].map(charity_counts).fillna(0).astype(np.int64)
+    df_charities['total_signups'] = total_signups.where(~df_charities['charity'].duplicated(), 0)
 
-    df_charities['total_signups'] = 0
-    
-    for i in range(len(df_charities)):
-        charity_name = df_charities.at[i, 'charity']
-        count = charity_counts[charity_name]
-        del charity_counts[charity_name]
-        df_charities.at[i, 'total_signups'] = count
+    charity_counts = charity_counts[~charity_counts.index.isin(df_charities['charity'])]
 
-    print("The following places were in the signups, but did not appear in the input file (" + str(PLACES_FILEPATH) + "):")
+    print("The following places were in the signups, but did not appear in the input file (" + str(places_filepath) + "):")
     for pair in charity_counts.items():
         print("    -" + pair[0] + "     appeared " + str(pair[1]) + " times")
-    print("This may be because you changed the name of the option on the Google Form after people had signed up to it. If this is the case, please use CTRL-F on one of the Excel documents and replace all instances of the previous option name to the updated name so they're consistent")
+    print("This may be because you changed the name of the option on the Google Form after people had signed up to it. If this is the case, you can put the right place next to it in " + PLACE_ALIASES_FILENAME + " (with 'yes' in the accepted column) and it'll be fixed automatically when you rerun. Or, please use CTRL-F on one of the Excel documents and replace all instances of the previous option name to the updated name so they're consistent")
     print("Otherwise, if you were expecting for an option to not be included (because that option is no longer available but students already signed up for it, or because you're assigning people there manually), you can ignore it in this list")
     print("\n")
     
 
 # For each charity, the ratio of signups : max possible places is what we use for sorting, here labelled as "ratio" 
-def get_charity_ratios(df_charities, df_signups):
-    count_num_time_charity_picked(df_charities, df_signups)
+def get_charity_ratios(df_charities, df_signups, places_filepath = PLACES_FILEPATH):
+    count_num_time_charity_picked(df_charities, df_signups, places_filepath)
     df_charities['ratio'] = df_charities.total_signups / df_charities.max_number
     
 # Sorts charities so we deprioritise charities who had significantly more interest than possible places to fill
-def sort_charities_by_ratio(df_charities, df_signups):
-    df_charities.sort_values('ratio', inplace = True)
+# If rng is given, each ratio gets randomly nudged by up to ORDER_NOISE first, so charities with similar ratios can swap (see OPTIMISING THE ORDER)
+def sort_charities_by_ratio(df_charities, df_signups, rng = None):
+    if rng is None:
+        df_charities.sort_values('ratio', inplace = True)
+    else:
+        df_charities['sort_key'] = df_charities['ratio'] * rng.uniform(1 - ORDER_NOISE, 1 + ORDER_NOISE, len(df_charities))
+        df_charities.sort_values('sort_key', inplace = True)
+        df_charities.drop(columns = 'sort_key', inplace = True)
     df_charities.reset_index(inplace = True, drop = True)
     
 # Sort participants so we prioritise placing large groups and groups who didn't select many charities. 
 # While this does reward people who made our life difficult and only selected one/two places, it also means we're
 # more likely to place everyone
-def sort_participants_by_group_size_and_num_charities_selected(df_signups):
-    df_signups.sort_values(['num_participants', 'num_charities_picked'], ascending = [False, True], inplace = True)
+# If rng is given, groups of the same size who picked a similar number of charities get shuffled around (big groups still always go first)
+def sort_participants_by_group_size_and_num_charities_selected(df_signups, rng = None):
+    if rng is None:
+        df_signups.sort_values(['num_participants', 'num_charities_picked'], ascending = [False, True], inplace = True)
+    else:
+        df_signups['sort_key'] = df_signups['num_charities_picked'] * rng.uniform(1 - ORDER_NOISE, 1 + ORDER_NOISE, len(df_signups))
+        df_signups.sort_values(['num_participants', 'sort_key'], ascending = [False, True], inplace = True)
+        df_signups.drop(columns = 'sort_key', inplace = True)
     df_signups.reset_index(inplace = True, drop = True)
 
 
+# PLACE NAME MATCHING ---------------------------------------------------------------------
+# People's picks only count if they're exactly the same as a name in the places input, so if an option got renamed slightly on the Google Form
+# (or someone typed it into "Other") the signups for it get lost. This matches up names which only differ in capitals, spaces or punctuation,
+# pieces of names which got split up at a comma, and anything in the aliases file that's been marked as accepted. Anything left over gets the
+# closest real place suggested, which is saved to the aliases file so it can be accepted for next time
+
+MAX_NAME_FRAGMENTS = 5 # Names with up to this many pieces (ie. 4 commas) get stuck back together if they've been split up
+MIN_SUGGESTION_SIMILARITY = 0.6 # Places less similar than this (from 0 to 1) aren't worth suggesting
+
+# Lower case, and with all the punctuation (including commas) and extra spaces taken out
+def normalise_place_name(name):
+    return ' '.join(re.sub(r'[^\w\s]', ' ', str(name).lower().replace('&', ' and ')).split())
+
+# Looks up places by their normalised name, and finds the closest place to a name which doesn't match anything. To stay quick with lots of
+# places, the close matches are found by first picking out the places which share the most 3-letter chunks with the name (ignoring chunks
+# which nearly every place has, like "the"), and then only comparing it properly (with difflib) against those
+class PlaceNameIndex:
+    def __init__(self, place_names, num_candidates = 10):
+        self.place_names = list(place_names)
+        self.num_candidates = num_candidates
+        self.index = {}
+        self.normalised_names = [normalise_place_name(place_name) for place_name in self.place_names]
+
+        place_ids_by_trigram = defaultdict(list)
+        for place_id, (place_name, normalised_name) in enumerate(zip(self.place_names, self.normalised_names)):
+            if normalised_name in self.index:
+                continue # If a place is in the input twice, only the first one is used (like in count_num_time_charity_picked)
+            self.index[normalised_name] = place_name
+            for trigram in set(get_trigrams(normalised_name)):
+                place_ids_by_trigram[trigram].append(place_id)
+        self.place_ids_by_trigram = {trigram: np.array(place_ids, dtype = np.int64) for trigram, place_ids in place_ids_by_trigram.items()}
+        self.max_common_trigram_places = max(50, len(self.place_names) // 5)
+
+    # Returns the place with the same normalised name, or None if there isn't one
+    def find(self, name):
+        return self.index.get(normalise_place_name(name))
+
+    # Returns the closest place and how similar it is (from 0 to 1), or (None, 0) if nothing is close enough
+    def suggest(self, name):
+        normalised_name = normalise_place_name(name)
+        postings = [self.place_ids_by_trigram[trigram] for trigram in set(get_trigrams(normalised_name)) if trigram in self.place_ids_by_trigram]
+        if len(postings) == 0:
+            return None, 0
+        rare_postings = [place_ids for place_ids in postings if len(place_ids) <= self.max_common_trigram_places]
+        shared_trigram_counts = np.bincount(np.concatenate(rare_postings if len(rare_postings) > 0 else postings), minlength = len(self.place_names))
+
+        # Same as difflib.get_close_matches, the cheap upper bounds on the similarity get checked first so most candidates get skipped quickly
+        candidates = np.argsort(-shared_trigram_counts, kind = 'stable')[:self.num_candidates]
+        sequence_matcher = difflib.SequenceMatcher()
+        sequence_matcher.set_seq2(normalised_name)
+        best_place_name, best_similarity = None, MIN_SUGGESTION_SIMILARITY
+        for place_id in candidates:
+            if shared_trigram_counts[place_id] == 0:
+                break
+            sequence_matcher.set_seq1(self.normalised_names[place_id])
+            if sequence_matcher.real_quick_ratio() <= best_similarity or sequence_matcher.quick_ratio() <= best_similarity:
+                continue
+            similarity = sequence_matcher.ratio()
+            if similarity > best_similarity:
+                best_place_name, best_similarity = self.place_names[place_id], similarity
+        if best_place_name is None:
+            return None, 0
+        return best_place_name, best_similarity
+
+def get_trigrams(normalised_name):
+    padded_name = "  " + normalised_name + " "
+    return [padded_name[i:i + 3] for i in range(len(padded_name) - 2)]
+
+# Replaces the names in each signup's charity_list with the matching place from the places input where there is one. Signups whose picks are
+# all already exact matches are left exactly as they were. If place_aliases_filepath is given, accepted aliases are read from it, and
+# suggestions for the names which still don't match anything are added to it (unless save_suggestions is False)
+def resolve_place_names(df_charities, df_signups, place_aliases_filepath = None, save_suggestions = True):
+    place_name_index = PlaceNameIndex(df_charities['charity'])
+    place_names = set(df_charities['charity'])
+    aliases = read_place_aliases(place_aliases_filepath, place_name_index)
+
+    # Work out what each different name in the signups is, just once per name
+    resolved_names = {}
+    for name in df_signups['charity_list'].explode().dropna().unique():
+        if name in place_names or name == '':
+            continue
+        resolved_name = place_name_index.find(name) or aliases.get(normalise_place_name(name))
+        resolved_names[name] = resolved_name # None if we'll need to try sticking it together with the names next to it
+
+    # Then fix up the signups which had any names which weren't exact matches
+    charity_lists = df_signups['charity_list'].tolist()
+    fixed_names = defaultdict(int)
+    for i, charity_list in enumerate(charity_lists):
+        if resolved_names.keys().isdisjoint(charity_list):
+            continue
+        charity_lists[i] = resolve_charity_list(charity_list, resolved_names, place_name_index, aliases, fixed_names)
+    # Made as an object column, so it's still a column of lists (rather than floats) when there aren't any signups
+    df_signups['charity_list'] = pd.Series(charity_lists, index = df_signups.index, dtype = object)
+    df_signups['num_charities_picked'] = np.fromiter(map(len, charity_lists), dtype = np.int64, count = len(charity_lists))
+
+    if len(fixed_names) > 0:
+        print("The following places in the signups were spelled a bit differently to the places input (or were in " + PLACE_ALIASES_FILENAME + "), so they've been matched up:")
+        for (name, place_name), count in fixed_names.items():
+            print("    -" + name + "     ->     " + place_name + "     (" + str(count) + " times)")
+        print("\n")
+
+    # Suggest the closest place for everything that's still left over
+    leftover_names = pd.Series(charity_lists, dtype = object).explode().dropna()
+    leftover_names = leftover_names[~leftover_names.isin(place_names) & (leftover_names != '')].unique()
+    suggestions = [(name,) + place_name_index.suggest(name) for name in leftover_names]
+    if len(suggestions) > 0:
+        print("These places in the signups don't match any place in the input file. The closest place to each is:")
+        for name, place_name, similarity in suggestions:
+            if place_name is None:
+                print("    -" + name + "     doesn't look like any of the places")
+            else:
+                print("    -" + name + "     might be     " + place_name + "     (" + str(round(100 * similarity)) + "% similar)")
+        if place_aliases_filepath is not None and save_suggestions:
+            print("These are listed in " + str(place_aliases_filepath) + ". If a suggestion is right (or you type the right place in), put 'yes' in its accepted column and it'll be used next time you run this")
+        print("\n")
+        if place_aliases_filepath is not None and save_suggestions:
+            save_place_alias_suggestions(place_aliases_filepath, suggestions)
+
+# Goes through one signup's picks, swapping in the resolved names, and sticking pieces of names back together where that makes a real place
+def resolve_charity_list(charity_list, resolved_names, place_name_index, aliases, fixed_names):
+    new_charity_list = []
+    i = 0
+    while i < len(charity_list):
+        # Longest first, and only if one of the pieces didn't match anything by itself
+        for j in range(min(len(charity_list), i + MAX_NAME_FRAGMENTS), i + 1, -1):
+            if all(resolved_names.get(name, name) is not None for name in charity_list[i:j]):
+                continue
+            merged_name = ', '.join(charity_list[i:j])
+            resolved_name = place_name_index.find(merged_name) or aliases.get(normalise_place_name(merged_name))
+            if resolved_name is not None:
+                fixed_names[(merged_name, resolved_name)] += 1
+                new_charity_list.append(resolved_name)
+                i = j
+                break
+        else:
+            name = charity_list[i]
+            resolved_name = resolved_names.get(name)
+            if resolved_name is not None:
+                fixed_names[(name, resolved_name)] += 1
+                new_charity_list.append(resolved_name)
+            else:
+                new_charity_list.append(name)
+            i += 1
+
+    return list(dict.fromkeys(new_charity_list)) # Two different spellings of the same place shouldn't count twice
+
+# Returns the accepted aliases as normalised name -> place name
+def read_place_aliases(place_aliases_filepath, place_name_index):
+    aliases = {}
+    if place_aliases_filepath is None or not Path(place_aliases_filepath).exists():
+        return aliases
+
+    df_aliases = pd.read_csv(place_aliases_filepath, dtype = str, keep_default_na = False)
+    for name, place_name, accepted in zip(df_aliases['name_in_signups'], df_aliases['place'], df_aliases['accepted']):
+        if accepted.strip().lower() not in ['yes', 'y', 'true', 'x', '1']:
+            continue
+        resolved_place_name = place_name_index.find(place_name)
+        if resolved_place_name is None:
+            print("The alias '" + name + "' -> '" + place_name + "' in " + str(place_aliases_filepath) + " has been accepted, but '" + place_name + "' isn't in the places input, so it's been ignored")
+            continue
+        aliases[normalise_place_name(name)] = resolved_place_name
+    return aliases
+
+# Adds the suggestions to the aliases file (without touching anything that's already in there, since it might've been edited)
+def save_place_alias_suggestions(place_aliases_filepath, suggestions):
+    if Path(place_aliases_filepath).exists():
+        df_aliases = pd.read_csv(place_aliases_filepath, dtype = str, keep_default_na = False)
+    else:
+        df_aliases = pd.DataFrame(columns = ['name_in_signups', 'place', 'similarity', 'accepted'])
+
+    already_in_file = set(df_aliases['name_in_signups'].map(normalise_place_name))
+    new_rows = [{'name_in_signups': name, 'place': place_name if place_name is not None else '', 'similarity': str(round(similarity, 2)) if place_name is not None else '', 'accepted': ''} for name, place_name, similarity in suggestions if normalise_place_name(name) not in already_in_file]
+    if len(new_rows) == 0:
+        return
+
+    try:
+        pd.concat([df_aliases, pd.DataFrame(new_rows)], ignore_index = True).to_csv(place_aliases_filepath, index = False)
+    except PermissionError:
+        print("Couldn't save the suggestions to " + str(place_aliases_filepath) + ", probably because it's open. Close it and rerun to save them")
+
+
 # PROCESSING (PLACING PARTICIPANTS) -----------------------------------------------------------------------------
 
 # This actually does the process of assigning our participants to charities
-def assign_participants_to_charities(df_charities, df_signups):
-    # Initialising lists of where people have been assigned
-    df_charities['participant_count'] = 0
-    df_charities['participant_ids'] = [[] for i in range(len(df_charities))]
+# If previous_placements is given (signup id -> charity index, from get_previous_placements), those people are kept where they were and only
+# the new signups get placed, moving the previous people around only when there's no other way to fit the new ones in
+def assign_participants_to_charities(df_charities, df_signups, solver = SOLVER, max_recursions = MAX_RECURSIONS, previous_placements = None, report = None, split_into_components = SPLIT_INTO_COMPONENTS, max_num_emails = None):
+    # Everything below works on a compact copy of the dataframes, and the results only get written back at the end
+    state = PlacementState(df_charities, df_signups)
 
     # Check that every person has preferenced at least on charity which actually exists, and create a list of all the people who couldn't be assigned
-    ids_with_no_existing_options = []
-    all_existing_charities = set(df_charities['charity'])
+    ids_with_no_existing_options = state.get_ids_with_no_existing_options()
     too_late_signups_list = []
 
-    for i in range(len(df_signups)):
-        overlap = all_existing_charities & set(df_signups.loc[i, 'charity_list'])
-        if len(overlap) == 0: # Either this person preferenced no charities or the charities they preferenced don't exist in the charity list
-            ids_with_no_existing_options.append(i)
-        else:# Otherwise, this person has valid options so assign them
-            assign_to_charity(i, df_signups, df_charities, too_late_signups_list = too_late_signups_list)
+    start_time = time.perf_counter()
+
+    if previous_placements is not None:
+        solver = "incremental"
+        placed_in = place_previous_placements(state, previous_placements)
+        too_late_signups_list = assign_participants_by_flow(state, ids_with_no_existing_options, placed_in)
+        too_late_reason = "All of the options this group chose were full, and the flow solver couldn't find a chain of moves (each moving one group out of a place) to make space for them without splitting a group up or taking a place below its minimum. If the groups are different sizes, there might still be a way to fit them in by moving several groups at once"
+    elif split_into_components:
+        too_late_signups_list = place_participants_by_component(state, solver, ids_with_no_existing_options, max_recursions, report)
+        if solver == "flow":
+            too_late_reason = "All of the options this group chose were full, and the flow solver couldn't find a chain of moves (each moving one group out of a place) to make space for them without splitting a group up or taking a place below its minimum. If the groups are different sizes, there might still be a way to fit them in by moving several groups at once"
+        else:
+            too_late_reason = "All of the options this group chose were full, and they were the most recent signup and so get lowest priority"
+    else:
+        too_late_signups_list = place_participants(state, solver, ids_with_no_existing_options, max_recursions)
+        if solver == "flow":
+            too_late_reason = "All of the options this group chose were full, and the flow solver couldn't find a chain of moves (each moving one group out of a place) to make space for them without splitting a group up or taking a place below its minimum. If the groups are different sizes, there might still be a way to fit them in by moving several groups at once"
+        else:
+            too_late_reason = "All of the options this group chose were full, and they were the most recent signup and so get lowest priority"
+
+    state.write_back(df_charities, df_signups)
+    if report is not None:
+        report.info['solver'] = solver
+        report.counters.update(state.counters)
+
+    # Handy for comparing the solvers against each other
+    num_placed = df_charities['participant_count'].sum()
+    print("The " + solver + " solver placed " + str(num_placed) + " out of " + str(df_signups['num_participants'].sum()) + " participants in " + str(round(time.perf_counter() - start_time, 2)) + " seconds")
+    num_groups_who_bumped = (df_signups['num_bumps_caused'] > 0).sum()
+    if num_groups_who_bumped > 0:
+        print(str(num_groups_who_bumped) + " groups had to move other groups around to get placed, with the most moves caused by one group being " + str(df_signups['num_bumps_caused'].max()))
+    print("\n")
 
-    df_unassignable_people = generate_dataframe_of_unassignable_people(too_late_signups_list, ids_with_no_existing_options, df_signups)
+    df_unassignable_people = generate_dataframe_of_unassignable_people(too_late_signups_list, ids_with_no_existing_options, df_signups, too_late_reason, max_num_emails)
 
     return df_unassignable_people
 
 
-# We can assume here that everyone in this has at least one charity they can feasibly be added to
-# Add each signup to a charity that's currently got space for them
-def assign_to_charity(participant_id, df_signups, df_charities, index_to_skip = -1, num_recursions = 0, too_late_signups_list = []):
-    # We first try attempting to find a charity with less than the minimum required numbers
-    if assign_to_charities_below_min_numbers(participant_id, df_signups, df_charities):
-        return
-            
-    # If every charity for this person has their minimum required numbers, we will then try to fill to maximum (basically same process as above)
-    if assign_to_charities_between_min_and_max_numbers(participant_id, df_signups, df_charities):
-        return
+# Places everyone (apart from ids_to_skip) with the given solver, and returns the ids of the signups who couldn't be placed
+# If too_late_roots is given, it gets filled with the signup that was being placed when each of those people got kicked out (see COMPONENTS)
+def place_participants(state, solver, ids_to_skip, max_recursions = MAX_RECURSIONS, too_late_roots = None):
+    if solver == "flow":
+        too_late_signups_list = assign_participants_by_flow(state, ids_to_skip)
+        if too_late_roots is not None:
+            too_late_roots.extend(too_late_signups_list) # The flow solver always lists them in signup order
+        return too_late_signups_list
+
+    if solver == "heuristic":
+        too_late_signups_list = []
+        for i in range(state.num_signups):
+            if len(state.charity_options[i]) > 0: # Otherwise this person preferenced no charities or the charities they preferenced don't exist in the charity list
+                num_too_late = len(too_late_signups_list)
+                assign_to_charity(i, state, too_late_signups_list, max_recursions)
+                if too_late_roots is not None:
+                    too_late_roots.extend([i] * (len(too_late_signups_list) - num_too_late))
+        return too_late_signups_list
+
+    raise ValueError("Unknown solver '" + str(solver) + "', this should be either 'heuristic' or 'flow'")
+
+
+# The charities each signup picked, stored as one long array of charity indices plus where each signup's part of it starts (like a sparse
+# matrix), instead of a separate little array for each signup. preference_lists[i] gives signup i's charity indices
+class PreferenceLists:
+    def __init__(self, offsets, indices):
+        self.offsets = offsets
+        self.indices = indices
+        self.offsets_list = offsets.tolist() # The solvers look options up a lot, and slicing with python ints is about twice as quick
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, signup_id):
+        return self.indices[self.offsets_list[signup_id]:self.offsets_list[signup_id + 1]]
+
+    def __iter__(self):
+        for signup_id in range(len(self)):
+            yield self[signup_id]
+
+    def get_lengths(self):
+        return np.diff(self.offsets)
+
+    # Where these signups' entries are in indices (one signup after another), and the offsets they'd have on their own
+    def get_positions(self, signup_ids):
+        lengths = self.get_lengths()[signup_ids]
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        return offsets, np.repeat(self.offsets[signup_ids] - offsets[:-1], lengths) + np.arange(offsets[-1])
+
+    # Just these signups, with the charity indices swapped for local_charity_ids[index]
+    def get_subset(self, signup_ids, local_charity_ids):
+        offsets, positions = self.get_positions(signup_ids)
+        return PreferenceLists(offsets, local_charity_ids[self.indices[positions]])
+
+    # Everything these signups have, joined into one list (eg. the emails of everyone in a place)
+    def get_joined(self, signup_ids):
+        offsets, positions = self.get_positions(np.asarray(signup_ids, dtype = np.int64))
+        return self.indices[positions].tolist()
+
+
+# Reading single cells out of a dataframe is really slow, so the solvers work on this instead. Charities and signups are referred to by their
+# row number in the (already sorted) dataframes, and charity_options has the charities each signup picked which actually exist, in the same
+# order as df_charities (so the first option is always the one with the lowest ratio)
+class PlacementState:
+    def __init__(self, df_charities, df_signups):
+        self.num_charities = len(df_charities)
+        self.num_signups = len(df_signups)
+
+        self.min_numbers = df_charities['min_number'].to_numpy()
+        self.max_numbers = df_charities['max_number'].to_numpy()
+        self.participant_counts = np.zeros(self.num_charities, dtype = np.int64)
+        self.participant_ids = [[] for i in range(self.num_charities)]
+
+        self.group_sizes = df_signups['num_participants'].to_numpy()
+        self.timestamps = df_signups['timestamp'].to_numpy()
+        self.bumps_caused = np.zeros(self.num_signups, dtype = np.int64) # How many times placing each signup made someone else move
+        self.counters = defaultdict(int) # Counts of what the solver got up to, for the run report
+
+        # Turn every pick into the number of the place's name (its code in the list of place names), then into the charity indices with that name (usually
+        # just one, unless a place is in the input twice). Each signup's options are sorted and without repeats
+        place_names = pd.Index(df_charities['charity'].unique())
+        num_picks = df_signups['charity_list'].str.len().to_numpy() if self.num_signups > 0 else np.zeros(0, dtype = np.int64)
+        all_picks = np.fromiter(chain.from_iterable(df_signups['charity_list']), dtype = object, count = int(num_picks.sum()))
+        df_picks = pd.DataFrame({
+            'signup_id': np.repeat(np.arange(self.num_signups, dtype = np.int64), num_picks),
+            'name_code': place_names.get_indexer(all_picks).astype(np.int32),
+        })
+        df_charity_codes = pd.DataFrame({'name_code': place_names.get_indexer(df_charities['charity']).astype(np.int32), 'charity_id': np.arange(self.num_charities, dtype = np.int64)})
+        df_picks = df_picks.merge(df_charity_codes, on = 'name_code') # Picks of places that don't exist (code -1) drop out here
+
+        keys = np.unique(df_picks['signup_id'].to_numpy() * max(self.num_charities, 1) + df_picks['charity_id'].to_numpy())
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(keys // max(self.num_charities, 1), minlength = self.num_signups))]).astype(np.int64)
+        self.charity_options = PreferenceLists(offsets, keys % max(self.num_charities, 1))
+
+    def get_ids_with_no_existing_options(self):
+        return np.flatnonzero(self.charity_options.get_lengths() == 0).tolist()
+
+    def write_back(self, df_charities, df_signups):
+        df_charities['participant_count'] = self.participant_counts
+        df_charities['participant_ids'] = [np.array(ids, dtype = np.int32) for ids in self.participant_ids]
+        df_signups['num_bumps_caused'] = self.bumps_caused
+
+    # A separate state with just these charities and signups (both sorted lists of ids), numbered from 0 in the same order. Everyone in
+    # signup_ids can only have picked charities in charity_ids
+    def get_component(self, charity_ids, signup_ids):
+        component = PlacementState.__new__(PlacementState)
+        component.num_charities = len(charity_ids)
+        component.num_signups = len(signup_ids)
+
+        component.min_numbers = self.min_numbers[charity_ids]
+        component.max_numbers = self.max_numbers[charity_ids]
+        component.participant_counts = self.participant_counts[charity_ids]
+        local_signup_ids = dict(zip(signup_ids, range(len(signup_ids))))
+        component.participant_ids = [[local_signup_ids[signup_id] for signup_id in self.participant_ids[charity_id]] for charity_id in charity_ids]
+
+        component.group_sizes = self.group_sizes[signup_ids]
+        component.timestamps = self.timestamps[signup_ids]
+        component.bumps_caused = self.bumps_caused[signup_ids]
+        component.counters = defaultdict(int)
+
+        local_charity_ids = np.full(self.num_charities, -1, dtype = np.int64)
+        local_charity_ids[charity_ids] = np.arange(len(charity_ids))
+        component.charity_options = self.charity_options.get_subset(np.array(signup_ids, dtype = np.int64), local_charity_ids)
+        return component
+
+    # Copies the placements from a component made by get_component back into this state
+    def merge_component(self, component, charity_ids, signup_ids):
+        self.participant_counts[charity_ids] = component.participant_counts
+        for charity_id, ids in zip(charity_ids, component.participant_ids):
+            self.participant_ids[charity_id] = [signup_ids[i] for i in ids]
+        self.bumps_caused[signup_ids] = component.bumps_caused
+        for name, count in component.counters.items():
+            if name == 'max_recursion_depth':
+                self.counters[name] = max(self.counters[name], count)
+            else:
+                self.counters[name] += count
 
-    # If that's not possible, we need to check if this recursion has just been going forever. If it has, we flag the participants as needing to be added manually
-    if num_recursions > MAX_RECURSIONS:
-        find_and_replace_latest_signups(participant_id, df_signups, df_charities, too_late_signups_list)
-        return
 
-    # There's no charity which currently has space, so we'll go the one which has the smallest signup:max ratio, and force the previously added person to move
-    if assign_to_charity_and_move_most_recent_addition(participant_id, df_signups, df_charities, index_to_skip, num_recursions, too_late_signups_list):
-        return
-
-    # If we get to this point without being able to put the participant anywhere, either we have a problem or we need to put them in the charity we bumped them from
-    if index_to_skip == -1:
-        print("There's an error somewhere in the participant assigning code lol. This is probably because there are places which are in signups but not in the input file")
-        # print(df_signups.loc[participant_id, :])
-        # print("Recursion num:" + str(num_recursions))
-    else:
-        # Since we haven't been able to assign this participant to any other charity than the one they were originally bumped from, we'll assign them there and recurse
-        assign_to_previously_bumped_from_charity(participant_id, df_signups, df_charities, index_to_skip, num_recursions, too_late_signups_list)
-        return
+# We can assume here that everyone in this has at least one charity they can feasibly be added to
+# Add each signup to a charity that's currently got space for them. If there isn't one, someone gets bumped and then needs a new spot
+# themselves, and so on. This used to be done with recursion, but now it's a worklist so it can't run out of stack on big events, and
+# we remember who has been bumped from where so we notice straight away when the bumping starts going around in circles
+def assign_to_charity(participant_id, state, too_late_signups_list, max_recursions = MAX_RECURSIONS):
+    root_id = participant_id # The signup we're actually trying to place, who gets the blame for any bumping
+    worklist = deque([(participant_id, -1, 0)])
+    visited = {} # (person being placed, place they were bumped from, touched_charities_hash) -> how many bumps in we were
+    touched_charity_hashes = {} # Place -> hash of who's in it, for each place the bumping has changed
+    touched_charities_hash = 0 # All of those combined (xor), so it can be updated one place at a time
+
+    while worklist:
+        participant_id, index_to_skip, num_recursions = worklist.popleft()
+        state.counters['max_recursion_depth'] = max(state.counters['max_recursion_depth'], num_recursions)
+
+        # We first try attempting to find a charity with less than the minimum required numbers
+        if assign_to_charities_below_min_numbers(participant_id, state):
+            state.counters['direct_placements'] += 1
+            continue
+
+        # If every charity for this person has their minimum required numbers, we will then try to fill to maximum (basically same process as above)
+        if assign_to_charities_between_min_and_max_numbers(participant_id, state):
+            state.counters['direct_placements'] += 1
+            continue
+
+        # If that's not possible, we need to check if the bumping has just been going forever. If so, we flag the participants as needing to
+        # be added manually
+        if num_recursions > max_recursions:
+            state.counters['max_recursions_reached'] += 1
+            find_and_replace_latest_signups(participant_id, state, too_late_signups_list)
+            continue
+
+        # If everything is exactly how it was at an earlier step (the same person getting bumped from the same place, and every place the
+        # bumping has touched with the same people in the same order), we're going round a loop which will keep repeating until we run out
+        # of recursions. Rather than going round it again and again, skip ahead whole loops, so we end up in exactly the same place as we
+        # would've. Someone getting bumped from the same place again isn't enough by itself, since each bump puts the new person at the front
+        # of the list, so the place has usually moved on to someone else by then
+        bump_state = (participant_id, index_to_skip, touched_charities_hash)
+        if bump_state in visited:
+            loop_length = num_recursions - visited[bump_state]
+            steps_skipped = (max_recursions + 1 - num_recursions) // loop_length * loop_length
+            state.counters['bump_cycles_detected'] += 1
+            state.bumps_caused[root_id] += steps_skipped # Counted as if they'd happened, so this is the same as going round the loop
+            num_recursions += steps_skipped
+            visited.clear()
+        visited[bump_state] = num_recursions
+
+        # Everything below only changes this place, so that's the only one whose part of the hash needs updating
+        charity_to_bump_from = get_charity_to_bump_from(participant_id, state, index_to_skip)
+        touched_charities_hash ^= touched_charity_hashes.get(charity_to_bump_from, 0)
+
+        # There's no charity which currently has space, so we'll go the one which has the smallest signup:max ratio, and force the previously added person to move
+        bumped_id, bumped_from_index = assign_to_charity_and_move_most_recent_addition(participant_id, state, index_to_skip)
+
+        # If we get to this point without being able to put the participant anywhere, either we have a problem or we need to put them in the charity we bumped them from
+        if bumped_id is None:
+            if index_to_skip == -1:
+                print("There's an error somewhere in the participant assigning code lol. This is probably because there are places which are in signups but not in the input file")
+                continue
+            # Since we haven't been able to assign this participant to any other charity than the one they were originally bumped from, we'll assign them there
+            bumped_id, bumped_from_index = assign_to_previously_bumped_from_charity(participant_id, state, index_to_skip)
+
+        touched_charity_hashes[charity_to_bump_from] = hash((charity_to_bump_from, tuple(state.participant_ids[charity_to_bump_from])))
+        touched_charities_hash ^= touched_charity_hashes[charity_to_bump_from]
+
+        # The bumped person now needs a spot (if possible, not the one they got popped from)
+        state.bumps_caused[root_id] += 1
+        state.counters['bumps'] += 1
+        worklist.append((bumped_id, bumped_from_index, num_recursions + 1))
 
             
 
 # Returns true if there was a charity below the minimum numbers to add the participant to
-def assign_to_charities_below_min_numbers(participant_id, df_signups, df_charities):
-    participant_charity_list = df_signups.loc[participant_id, 'charity_list']
-    num_participants_in_group = df_signups.loc[participant_id, 'num_participants']
-
-    for charity_index in range(len(df_charities)):
-        if (df_charities.loc[charity_index, 'charity'] in participant_charity_list):
-            if (df_charities.loc[charity_index, 'participant_count'] + num_participants_in_group) <= df_charities.loc[charity_index, 'min_number']:
-                # There's space in this preference for the group/participant. Add them
-                add_participant_to_charity(participant_id, charity_index, df_signups, df_charities)
-                # print("Success for ID " + str(i) + " assigned to " + df_charities.loc[charity_index, 'charity'])
-                return True
-    
-    return False
+def assign_to_charities_below_min_numbers(participant_id, state):
+    return assign_to_first_charity_under_limit(participant_id, state, state.min_numbers)
 
 # Returns true if there was a charity which is between the minimum and maximum numbers when a participant/group is added
-def assign_to_charities_between_min_and_max_numbers(participant_id, df_signups, df_charities):
-    participant_charity_list = df_signups.loc[participant_id, 'charity_list']
-    num_participants_in_group = df_signups.loc[participant_id, 'num_participants']
+def assign_to_charities_between_min_and_max_numbers(participant_id, state):
+    return assign_to_first_charity_under_limit(participant_id, state, state.max_numbers)
 
-    for charity_index in range(len(df_charities)):
-        if (df_charities.loc[charity_index, 'charity'] in participant_charity_list):
-            if (df_charities.loc[charity_index, 'participant_count'] + num_participants_in_group) <= df_charities.loc[charity_index, 'max_number']:
-                add_participant_to_charity(participant_id, charity_index, df_signups, df_charities)
-                # print("Success for ID " + str(i) + " assigned to " + df_charities.loc[charity_index, 'charity'])
-                return True
-            
-    return False
+# Checks all of this participant's options at once, and adds them to the first (lowest ratio) one which still fits them under the limit
+def assign_to_first_charity_under_limit(participant_id, state, limits):
+    options = state.charity_options[participant_id]
+    fits = state.participant_counts[options] + state.group_sizes[participant_id] <= limits[options]
 
-# We've exceeded our maximum number of recursions, so we'll place this participant in the list, and then bump off the participants who signed up too late (by timestamp)
-def find_and_replace_latest_signups(participant_id, df_signups, df_charities, too_late_signups_list):
-    participant_charity_list = df_signups.loc[participant_id, 'charity_list']
-    num_participants_in_group = df_signups.loc[participant_id, 'num_participants']
+    if fits.any():
+        # There's space in this preference for the group/participant. Add them
+        add_participant_to_charity(participant_id, int(options[fits.argmax()]), state)
+        return True
 
-    # We'll add this participant to the first possible charity in the list, because chances are that's where the problem is lol
-    for charity_index in range(len(df_charities)):
-        if (df_charities.loc[charity_index, 'charity'] in participant_charity_list):
-            
-            add_participant_to_charity(participant_id, charity_index, df_signups, df_charities)
-
-            df_charities.at[charity_index, 'participant_ids'] = sorted(df_charities.at[charity_index, 'participant_ids'], key = lambda id: df_signups.at[id, 'timestamp']) # I probs need to check this works lol
-            
-            # Note the participant/s who signed up late and need to be bumped off so this charity can be below the minimum numbers
-            while df_charities.at[charity_index, 'participant_count'] > df_charities.at[charity_index, 'max_number']:
-                last_signup_id = pop_most_recently_added_participant(charity_index, df_signups, df_charities)
-                too_late_signups_list.append(last_signup_id)
-            
-            return
+    return False
 
-# Returns true if there is somewhere this participant can be added that is NOT where they were previously bumped from (taking the place of whoever was most recently added)
-def assign_to_charity_and_move_most_recent_addition(participant_id, df_signups, df_charities, index_to_skip, num_recursions, too_late_signups_list):
-    participant_charity_list = df_signups.loc[participant_id, 'charity_list']
-    num_participants_in_group = df_signups.loc[participant_id, 'num_participants']
+# We've bumped for too long (or started going in circles), so we'll place this participant in the list, and then bump off the participants who signed up too late (by timestamp)
+def find_and_replace_latest_signups(participant_id, state, too_late_signups_list):
+    state.counters['find_and_replace_latest_signups_fallbacks'] += 1
 
-    for charity_index in range(len(df_charities)):
-        if (df_charities.loc[charity_index, 'charity'] in participant_charity_list) and (charity_index != index_to_skip):
+    # We'll add this participant to the first possible charity in the list, because chances are that's where the problem is lol
+    charity_index = int(state.charity_options[participant_id][0])
+
+    add_participant_to_charity(participant_id, charity_index, state)
+
+    state.participant_ids[charity_index].sort(key = lambda id: state.timestamps[id])
+
+    # Note the participant/s who signed up late and need to be bumped off so this charity can be below the minimum numbers
+    while state.participant_counts[charity_index] > state.max_numbers[charity_index]:
+        last_signup_id = pop_most_recently_added_participant(charity_index, state)
+        too_late_signups_list.append(last_signup_id)
+
+# The place this participant would go and bump someone out of: their first option that isn't where they were just bumped from, or that place
+# again if it's their only option
+def get_charity_to_bump_from(participant_id, state, index_to_skip):
+    for charity_index in state.charity_options[participant_id]:
+        if charity_index != index_to_skip:
+            return int(charity_index)
+    return index_to_skip
+
+# If there is somewhere this participant can be added that is NOT where they were previously bumped from, adds them there (taking the place of whoever
+# was most recently added). Returns the id of the person who got bumped and where they got bumped from, or (None, None) if there was nowhere
+def assign_to_charity_and_move_most_recent_addition(participant_id, state, index_to_skip):
+    for charity_index in state.charity_options[participant_id]:
+        charity_index = int(charity_index)
+        if charity_index != index_to_skip:
         
             # Bump off the most recent addition to this group and force them to go to a different charity lol
-            most_recent_addition_id = pop_most_recently_added_participant(charity_index, df_signups, df_charities)
+            most_recent_addition_id = pop_most_recently_added_participant(charity_index, state)
 
-            prepend_participant_to_charity(participant_id, charity_index, df_signups, df_charities) # Prepend the ID (to make infinite loops only occur after checking the whole list)
-            # print ("ID " + str(i) + " assigned to " + df_charities.loc[charity_index, 'charity'])
+            prepend_participant_to_charity(participant_id, charity_index, state) # Prepend the ID (to make infinite loops only occur after checking the whole list)
 
-            # Assign the popped id to a charity (if possible, not this one which they got popped from)
-            assign_to_charity(most_recent_addition_id, df_signups, df_charities, index_to_skip = charity_index, num_recursions = num_recursions + 1, too_late_signups_list = too_late_signups_list)
-            return True
+            return most_recent_addition_id, charity_index
         
-    return False
-    
-# Assigns the participant to the charity they were previously bumped from
-def assign_to_previously_bumped_from_charity(participant_id, df_signups, df_charities, index_to_skip, num_recursions, too_late_signups_list):
-    num_participants_in_group = df_signups.loc[participant_id, 'num_participants']
+    return None, None
     
+# Assigns the participant to the charity they were previously bumped from. Returns the id of the person who got bumped to make room, and where from
+def assign_to_previously_bumped_from_charity(participant_id, state, index_to_skip):
     # Bump off the most recent addition to this group and force them to go to a different charity lol
-    most_recent_addition_id = pop_most_recently_added_participant(index_to_skip, df_signups, df_charities)
+    most_recent_addition_id = pop_most_recently_added_participant(index_to_skip, state)
 
-    prepend_participant_to_charity(participant_id, index_to_skip, df_signups, df_charities) # Prepend the ID (to make infinite loops only occur after checking the whole list)
+    prepend_participant_to_charity(participant_id, index_to_skip, state) # Prepend the ID (to make infinite loops only occur after checking the whole list)
 
-    # print ("ID " + str(participant_id) + " assigned to " + df_charities.loc[index_to_skip, 'charity'])
+    return most_recent_addition_id, index_to_skip
 
-    # Assign the popped id to a charity (if possible, not this one which they got popped from)
-    assign_to_charity(most_recent_addition_id, df_signups, df_charities, index_to_skip = index_to_skip, num_recursions = num_recursions + 1, too_late_signups_list = too_late_signups_list)
-    return
 
+def add_participant_to_charity(participant_id, charity_index, state):
+    state.participant_counts[charity_index] += state.group_sizes[participant_id]
+    state.participant_ids[charity_index].append(participant_id)
 
-def add_participant_to_charity(participant_id, charity_index, df_signups, df_charities):
-    df_charities.at[charity_index, 'participant_count'] = df_charities.loc[charity_index, 'participant_count'] + df_signups.loc[participant_id, 'num_participants']
-    df_charities.at[charity_index, 'participant_ids'].append(participant_id)
 
+def prepend_participant_to_charity(participant_id, charity_index, state):
+    state.participant_counts[charity_index] += state.group_sizes[participant_id]
+    state.participant_ids[charity_index].insert(0, participant_id) 
 
-def prepend_participant_to_charity(participant_id, charity_index, df_signups, df_charities):
-    df_charities.at[charity_index, 'participant_count'] = df_charities.loc[charity_index, 'participant_count'] + df_signups.loc[participant_id, 'num_participants']
-    df_charities.at[charity_index, 'participant_ids'].insert(0, participant_id) 
-
-def pop_most_recently_added_participant(charity_index, df_signups, df_charities):
-    most_recent_addition_id = df_charities.at[charity_index, 'participant_ids'].pop()
-    num_participants_for_that_id = df_signups.loc[most_recent_addition_id, 'num_participants']
-    df_charities.at[charity_index, 'participant_count'] = df_charities.loc[charity_index, 'participant_count'] - num_participants_for_that_id
+def pop_most_recently_added_participant(charity_index, state):
+    most_recent_addition_id = state.participant_ids[charity_index].pop()
+    state.participant_counts[charity_index] -= state.group_sizes[most_recent_addition_id]
     return most_recent_addition_id
 
+
+# COMPONENTS (SPLITTING UP THE PLACES THAT DON'T AFFECT EACH OTHER) -----------------------------
+# Lots of signups only pick from a small cluster of places (eg. all on one campus). Groups in one cluster can never bump groups in another,
+# so each cluster (a "component") can be placed on its own, and big ones on different CPU cores at the same time. The components are found
+# with union-find: every place a signup picked gets joined together with their other picks.
+# Each component's signups are placed in the same order as they would be otherwise, so everyone ends up in exactly the same place. The only
+# thing to be careful of is the list of people who couldn't be placed, which gets put back in the order they got kicked out: by the signup
+# that was being placed at the time, then the order within that
+
+# Returns a list of (charity ids, signup ids) for each component which has any signups in it, biggest first
+def find_components(state):
+    parent = list(range(state.num_charities))
+
+    def find_root(charity_id):
+        while parent[charity_id] != charity_id:
+            parent[charity_id] = parent[parent[charity_id]] # Shortcut the path on the way up so later finds are quicker
+            charity_id = parent[charity_id]
+        return charity_id
+
+    for options in state.charity_options:
+        if len(options) > 1:
+            root = find_root(int(options[0]))
+            for charity_id in options[1:]:
+                other_root = find_root(int(charity_id))
+                if other_root != root:
+                    parent[other_root] = root
+
+    charity_ids_by_root = defaultdict(list)
+    for charity_id in range(state.num_charities):
+        charity_ids_by_root[find_root(charity_id)].append(charity_id)
+    signup_ids_by_root = defaultdict(list)
+    for signup_id, options in enumerate(state.charity_options):
+        if len(options) > 0:
+            signup_ids_by_root[find_root(int(options[0]))].append(signup_id)
+
+    components = [(charity_ids_by_root[root], signup_ids) for root, signup_ids in signup_ids_by_root.items()]
+    components.sort(key = lambda component: -len(component[1]))
+    return components
+
+# Places one component on its own. Returns the component (with everyone placed), the people who couldn't be placed, and who was being
+# placed when they got kicked out
+def solve_component(component, solver, max_recursions):
+    too_late_roots = []
+    too_late_signups_list = place_participants(component, solver, [], max_recursions, too_late_roots)
+    return component, too_late_signups_list, too_late_roots
+
+# Same as place_participants, but placing each component separately. Returns the ids of the signups who couldn't be placed
+def place_participants_by_component(state, solver, ids_to_skip, max_recursions = MAX_RECURSIONS, report = None, num_workers = COMPONENT_WORKERS, min_parallel_signups = MIN_PARALLEL_COMPONENT_SIGNUPS):
+    from concurrent.futures import ProcessPoolExecutor
+
+    skip = set(ids_to_skip)
+    components = [(charity_ids, [i for i in signup_ids if i not in skip]) for charity_ids, signup_ids in find_components(state)]
+    report_component_sizes(components, state.num_signups - len(skip), report)
+
+    # Big components go to other processes if there's more than one of them (otherwise there's nothing to do at the same time)
+    num_workers = num_workers or os.cpu_count() or 1
+    num_big_components = sum(len(signup_ids) >= min_parallel_signups for charity_ids, signup_ids in components)
+    use_processes = num_workers > 1 and num_big_components > 1
+
+    too_late_entries = []
+    executor = ProcessPoolExecutor(max_workers = min(num_workers, num_big_components)) if use_processes else None
+    try:
+        # The small ones get placed here while the big ones are going in the other processes
+        futures = []
+        for charity_ids, signup_ids in components:
+            component = state.get_component(charity_ids, signup_ids)
+            if use_processes and len(signup_ids) >= min_parallel_signups:
+                futures.append((charity_ids, signup_ids, executor.submit(solve_component, component, solver, max_recursions)))
+            else:
+                merge_solved_component(state, charity_ids, signup_ids, solve_component(component, solver, max_recursions), too_late_entries)
+        for charity_ids, signup_ids, future in futures:
+            merge_solved_component(state, charity_ids, signup_ids, future.result(), too_late_entries)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    too_late_entries.sort()
+    return [signup_id for root_id, position, signup_id in too_late_entries]
+
+def merge_solved_component(state, charity_ids, signup_ids, solved, too_late_entries):
+    component, too_late_signups_list, too_late_roots = solved
+    state.merge_component(component, charity_ids, signup_ids)
+    for position, (signup_id, root_id) in enumerate(zip(too_late_signups_list, too_late_roots)):
+        too_late_entries.append((signup_ids[root_id], position, signup_ids[signup_id]))
+
+# How big the components are. The biggest one has to be placed by one CPU core on its own, so the most it could be sped up by using more
+# cores is the total number of signups divided by the number in the biggest component
+def report_component_sizes(components, num_signups, report = None):
+    sizes = np.array([len(signup_ids) for charity_ids, signup_ids in components], dtype = np.int64)
+    largest_size = int(sizes.max()) if len(sizes) > 0 else 0
+    size_buckets = {"1": 0, "2-9": 0, "10-99": 0, "100-999": 0, "1000-9999": 0, "10000+": 0}
+    for size in sizes:
+        bucket_index = 0 if size == 1 else min(len(str(size)), len(size_buckets) - 1) # ie. how many digits it has
+        size_buckets[list(size_buckets)[bucket_index]] += 1
+
+    if len(sizes) > 1:
+        print("The signups split up into " + str(len(sizes)) + " separate clusters of places, the biggest with " + str(largest_size) + " of the " + str(num_signups) + " signups")
+
+    if report is not None:
+        report.info['components'] = {
+            'num_components': len(sizes),
+            'largest_component_signups': largest_size,
+            'largest_component_places': len(components[0][0]) if len(components) > 0 else 0,
+            'median_component_signups': float(np.median(sizes)) if len(sizes) > 0 else 0,
+            'component_signups_distribution': size_buckets,
+            'max_parallel_speedup': num_signups / largest_size if largest_size > 0 else 1,
+        }
+
+
+# PROCESSING (FLOW-BASED SOLVER) --------------------------------------------------------
+# Instead of placing people and bumping whoever was added last, this treats the placement as a max-flow problem: signups on one side,
+# places on the other, and each place can take up to its capacity. A group is only added by finding an "augmenting path", ie. a chain of
+# moves like "put the new group in place A, move a group from A to B, move a group from B to C which has space". If no chain exists,
+# they get reported as unassignable instead of kicking someone else out.
+# Groups are never split up, which technically makes this a bin packing problem (no fast exact answer exists for that). So each place
+# on a chain only swaps one group out, big enough to make room for the one coming in. When all groups are the same size this finds
+# the best possible placement. With mixed sizes it can miss some: eg. with places A, B and C with room for 4, 2 and 3, and groups of 3
+# (picking C), 2 (A), 2 (A or B), 1 (A or B) and 1 (A or C), everyone fits. But once both 2s are in A and the first 1 is in B, the last
+# group only fits if the 2 and the 1 swap between A and B, and a chain can only go through each place once, so it places 8 of the 9 people.
+# It runs in two rounds: first only filling places up to their min_number, then up to their max_number. Moving groups along a chain
+# never drops a place below its minimum once it's reached it, so the minimums filled in the first round stay filled.
+
+# Places participants using augmenting paths. placed_in is a dict of signup id -> charity index for anyone who's already in the state (when adding
+# new signups to a previous placement), and gets updated with where everyone ends up. Returns the list of ids which couldn't be placed anywhere
+def assign_participants_by_flow(state, ids_to_skip, placed_in = None):
+    # The searches below do a lot of single lookups, which are quicker on plain lists than numpy arrays
+    group_sizes = state.group_sizes.tolist()
+    charity_options = [options.tolist() for options in state.charity_options]
+    participant_counts = state.participant_counts.tolist()
+    participant_ids = state.participant_ids
+    if placed_in is None:
+        placed_in = {}
+
+    skip = set(ids_to_skip)
+    ids_to_place = [i for i in range(state.num_signups) if i not in skip and i not in placed_in]
+
+    # Remembering where searches got stuck only works when all the groups are the same size. Then which groups can be moved out of a place
+    # doesn't depend on who's moving in, so a failed search has already tried everywhere reachable from where it got stuck. With mixed sizes a
+    # place might've only been a dead end because of the size of the group moving in or the order the search went in, so it isn't used
+    use_dead_ends = len(set(group_sizes)) <= 1
+
+    # In the first round places can't lose people at all, in the second round they just can't drop below their minimum
+    for limits, floors in [(state.min_numbers.tolist(), None), (state.max_numbers.tolist(), state.min_numbers.tolist())]:
+        dead_ends = set() # (place, incoming group size) pairs we've already searched from without finding space
+
+        for participant_id in ids_to_place:
+            if participant_id not in placed_in:
+                path = find_augmenting_path(participant_id, group_sizes, charity_options, limits, floors, participant_counts, participant_ids, dead_ends if use_dead_ends else None)
+                if path is None:
+                    state.counters['failed_augmenting_path_searches'] += 1
+                else:
+                    apply_augmenting_path(path, group_sizes, participant_counts, participant_ids, placed_in)
+                    state.bumps_caused[participant_id] += len(path) - 1
+                    state.counters['direct_placements' if len(path) == 1 else 'augmenting_paths'] += 1
+                    state.counters['bumps'] += len(path) - 1
+                    state.counters['max_recursion_depth'] = max(state.counters['max_recursion_depth'], len(path) - 1)
+                    dead_ends.clear() # Things have moved around, so somewhere we got stuck before might lead somewhere now
+
+    # Keep the same order as the sorted signups
+    for ids in participant_ids:
+        ids.sort()
+    state.participant_counts[:] = participant_counts
+
+    return [i for i in ids_to_place if i not in placed_in]
+
+
+# Breadth first search for the shortest chain of moves which makes space for this group. Returns a list of (group id, charity index) moves,
+# starting with the new group, or None if it couldn't find one. dead_ends (if it isn't None) has the places previous searches got stuck at,
+# which get skipped, and gets the places this search got stuck at added to it
+def find_augmenting_path(participant_id, group_sizes, charity_options, limits, floors, participant_counts, participant_ids, dead_ends):
+    group_size = group_sizes[participant_id]
+    options = charity_options[participant_id]
+
+    # Easy case first: one of their options already has space
+    for charity_index in options:
+        if participant_counts[charity_index] + group_size <= limits[charity_index]:
+            return [(participant_id, charity_index)]
+
+    # Otherwise search outwards. For each place we record where we came from and which group would be moving in
+    came_from = {charity_index: (None, participant_id) for charity_index in options}
+    searched = []
+    queue = deque(options)
+    while queue:
+        charity_index = queue.popleft()
+        incoming_size = group_sizes[came_from[charity_index][1]]
+        if dead_ends is not None and (charity_index, incoming_size) in dead_ends:
+            continue
+        searched.append((charity_index, incoming_size))
+
+        # The group we move out needs to make enough room, but can't take the place below its floor
+        space_needed = participant_counts[charity_index] + incoming_size - limits[charity_index]
+        if floors is None:
+            most_we_can_remove = incoming_size
+        else:
+            most_we_can_remove = participant_counts[charity_index] + incoming_size - min(participant_counts[charity_index], floors[charity_index])
+
+        for moved_id in participant_ids[charity_index]:
+            moved_size = group_sizes[moved_id]
+            if moved_size < space_needed or moved_size > most_we_can_remove:
+                continue
+            for next_charity_index in charity_options[moved_id]:
+                if next_charity_index in came_from:
+                    continue
+                came_from[next_charity_index] = (charity_index, moved_id)
+                if participant_counts[next_charity_index] + moved_size <= limits[next_charity_index]:
+                    return build_augmenting_path(next_charity_index, came_from)
+                queue.append(next_charity_index)
+
+    if dead_ends is not None:
+        dead_ends.update(searched)
+    return None
+
+# Walks back through the search to get the list of moves, ordered from the new group to the place with space
+def build_augmenting_path(last_charity_index, came_from):
+    path = []
+    charity_index = last_charity_index
+    while charity_index is not None:
+        previous_charity_index, moved_id = came_from[charity_index]
+        path.append((moved_id, charity_index))
+        charity_index = previous_charity_index
+    path.reverse()
+    return path
+
+def apply_augmenting_path(path, group_sizes, participant_counts, participant_ids, placed_in):
+    for participant_id, charity_index in path:
+        if participant_id in placed_in:
+            previous_charity_index = placed_in[participant_id]
+            participant_ids[previous_charity_index].remove(participant_id)
+            participant_counts[previous_charity_index] -= group_sizes[participant_id]
+        participant_ids[charity_index].append(participant_id)
+        participant_counts[charity_index] += group_sizes[participant_id]
+        placed_in[participant_id] = charity_index
+
+# INCREMENTAL PLACEMENT (ADDING LATE SIGNUPS TO A PREVIOUS OUTPUT) --------------------------------------------
+# Rerunning from scratch every time a few more signups come in shuffles everyone around, which is a pain if you've already emailed people.
+# Instead, this reads the previous output, keeps everyone where they were, and only places the new signups. Previous people only get
+# moved when there's no other way to fit a new group in (using the same augmenting paths as the flow solver), and everyone who got moved
+# or newly placed is listed in the output so you know exactly who to email.
+
+# Reads the "Places & Assigned Emails" table of a previous output, and returns a dict of signup id -> charity index for every signup whose
+# emails were all placed in the same place last time. Needs to be run after the dataframes are sorted, since the ids are row numbers
+def get_previous_placements(previous_placements_filepath, df_charities, df_signups, max_num_emails = None):
+    # This can also be the placements_output_places_assigned_emails file, if the output was saved as separate files
+    file_format = get_file_format(previous_placements_filepath)
+    if file_format == "xlsx":
+        df_previous = pd.read_excel(previous_placements_filepath, sheet_name = "Places & Assigned Emails")
+    elif file_format == "csv":
+        df_previous = pd.read_csv(previous_placements_filepath)
+    else:
+        df_previous = pd.read_parquet(previous_placements_filepath)
+
+    charity_ids_by_name = {}
+    for charity_index, charity_name in enumerate(df_charities['charity']):
+        charity_ids_by_name.setdefault(charity_name, charity_index)
+
+    previous_charities_for_email = defaultdict(set) # Usually just one, unless the email was repeated in the signups
+    for place, emails in zip(df_previous['place'], df_previous['participant_emails_as_string']):
+        if place in charity_ids_by_name and type(emails) == str:
+            for email in emails.split(';'):
+                previous_charities_for_email[email.strip().lower()].add(charity_ids_by_name[place])
+
+    previous_placements = {}
+    for i, participant_emails in enumerate(get_signup_emails(df_signups, max_num_emails)):
+        # If a group got split up or changed since last time, or we can't tell which place they were in, we just treat them as new
+        previous_charities = set.intersection(*[previous_charities_for_email.get(str(email).strip().lower(), set()) for email in participant_emails]) if len(participant_emails) > 0 else set()
+        if len(previous_charities) == 1:
+            previous_placements[i] = previous_charities.pop()
+
+    print(str(len(previous_placements)) + " of the " + str(len(df_signups)) + " signups were already placed in " + str(previous_placements_filepath) + ", so only the rest will be placed")
+    print("\n")
+
+    return previous_placements
+
+# Puts everyone from the previous output back where they were. Anyone whose previous place isn't one of their options anymore (because they
+# changed their response, or the place was renamed) gets left out, so they'll be placed again like a new signup
+def place_previous_placements(state, previous_placements):
+    placed_in = {}
+    for participant_id, charity_index in previous_placements.items():
+        if charity_index in state.charity_options[participant_id]:
+            add_participant_to_charity(participant_id, charity_index, state)
+            placed_in[participant_id] = charity_index
+    return placed_in
+
+# Creates a dataframe of everyone who's either new or in a different place compared to the previous output
+def generate_dataframe_of_changes(df_charities, df_signups, previous_placements, max_num_emails = None):
+    signup_emails = get_signup_emails(df_signups, max_num_emails)
+    changes = []
+    for charity_index in range(len(df_charities)):
+        for signup_id in df_charities.at[charity_index, 'participant_ids']:
+            previous_charity_index = previous_placements.get(signup_id)
+            if previous_charity_index is None:
+                changes.append([signup_emails[signup_id].tolist(), "", df_charities.at[charity_index, 'charity'], "New signup"])
+            elif previous_charity_index != charity_index:
+                changes.append([signup_emails[signup_id].tolist(), df_charities.at[previous_charity_index, 'charity'], df_charities.at[charity_index, 'charity'], "Moved to make space for a new signup"])
+
+    df_changes = pd.DataFrame(changes, columns = ['emails', 'previous_place', 'new_place', 'change'])
+    print(str((df_changes['change'] == "New signup").sum()) + " new signups were placed, and " + str((df_changes['change'] != "New signup").sum()) + " previously placed groups had to be moved to make space for them. See the output excel for who to email")
+    print("\n")
+
+    return df_changes
+
+
+# OPTIMISING THE ORDER (RANDOMISED RESTARTS) --------------------------------------------
+# How well the placing goes depends a lot on the order the places and signups get sorted into, and places/signups which are tied (or nearly tied)
+# just end up in whatever order they happen to be in. So when OPTIMISE_SECONDS is more than 0, we try lots of slightly shuffled orders (trials)
+# on all the CPU cores and keep whichever order gave the best placement. Trial 0 is always the normal order, so it can't do worse than without it.
+# Each trial's shuffle only depends on OPTIMISE_SEED and the trial number, so the best one gets recreated exactly in the main program afterwards.
+# How many trials get done depends on the time limit and how fast the computer is, so the same seed can pick a different best trial next time.
+# To get the same placement again, set OPTIMISE_TRIAL to the best trial number it printed, which just uses that trial's order
+
+# Sorts the (already normally sorted) dataframes into the order for this trial. Trial 0 is left as it is
+def sort_for_trial(df_charities, df_signups, seed, trial):
+    if trial == 0:
+        return
+    rng = np.random.default_rng([seed, trial])
+    sort_charities_by_ratio(df_charities, df_signups, rng)
+    sort_participants_by_group_size_and_num_charities_selected(df_signups, rng)
+
+# How good a placement is, where smaller is better. Compared in order, so eg. fewer places under their minimum always wins. That's followed by
+# how many people are over a place's maximum (which the heuristic can do), how many participants didn't get placed, and lastly how unfair it was
+# by signup time (each unplaced participant adds how early they signed up, from 0 for the last signup to 1 for the first)
+def get_placement_objective(state, unplaced_ids):
+    signup_order = pd.Series(state.timestamps).rank(method = 'average', pct = True).to_numpy() if state.num_signups > 0 else np.array([])
+    unplaced_ids = np.array(unplaced_ids, dtype = np.int64)
+
+    num_places_under_min = int((state.participant_counts < state.min_numbers).sum())
+    num_participants_over_max = int(np.maximum(state.participant_counts - state.max_numbers, 0).sum())
+    num_unplaced_participants = int(state.group_sizes[unplaced_ids].sum())
+    timestamp_unfairness = round(float((state.group_sizes[unplaced_ids] * (1 - signup_order[unplaced_ids])).sum()), 6)
+
+    return (num_places_under_min, num_participants_over_max, num_unplaced_participants, timestamp_unfairness)
+
+def run_placement_trial(df_charities, df_signups, solver, max_recursions, seed, trial):
+    df_charities = df_charities.copy()
+    df_signups = df_signups.copy()
+    sort_for_trial(df_charities, df_signups, seed, trial)
+
+    state = PlacementState(df_charities, df_signups)
+    ids_with_no_existing_options = state.get_ids_with_no_existing_options()
+    too_late_signups_list = place_participants(state, solver, ids_with_no_existing_options, max_recursions)
+
+    return get_placement_objective(state, ids_with_no_existing_options + too_late_signups_list)
+
+# Each worker runs trials worker, worker + num_workers, worker + 2*num_workers... until the time runs out (always doing at least one)
+def run_optimisation_worker(df_charities, df_signups, solver, max_recursions, seed, worker, num_workers, deadline):
+    results = []
+    trial = worker
+    while trial == worker or time.time() < deadline:
+        results.append((worker, trial, run_placement_trial(df_charities, df_signups, solver, max_recursions, seed, trial)))
+        trial += num_workers
+    return results
+
+# Tries shuffled orders for the given number of seconds, then sorts the dataframes into the best order found. Returns the best trial number
+def optimise_placement_order(df_charities, df_signups, solver = SOLVER, max_recursions = MAX_RECURSIONS, seconds = OPTIMISE_SECONDS, num_workers = OPTIMISE_WORKERS, seed = OPTIMISE_SEED, report = None):
+    from concurrent.futures import ProcessPoolExecutor
+
+    num_workers = num_workers or os.cpu_count() or 1
+    deadline = time.time() + seconds
+
+    if num_workers == 1:
+        results = run_optimisation_worker(df_charities, df_signups, solver, max_recursions, seed, 0, 1, deadline)
+    else:
+        with ProcessPoolExecutor(max_workers = num_workers) as executor:
+            futures = [executor.submit(run_optimisation_worker, df_charities, df_signups, solver, max_recursions, seed, worker, num_workers, deadline) for worker in range(num_workers)]
+            results = list(chain(*[future.result() for future in futures]))
+
+    best_worker, best_trial, best_objective = min(results, key = lambda result: (result[2], result[1]))
+    normal_objective = [result[2] for result in results if result[1] == 0][0]
+
+    # What the best would have been with fewer cores (ie. only the trials the first few workers did), to see whether the extra cores are worth it
+    best_objective_by_num_workers = [min(result[2] for result in results if result[0] < n) for n in range(1, num_workers + 1)]
+
+    print("Tried " + str(len(results)) + " different orders on " + str(num_workers) + " CPU cores, and the best was trial " + str(best_trial) + " (seed " + str(seed) + ")")
+    print("Normal order: " + describe_placement_objective(normal_objective))
+    print("Best order:   " + describe_placement_objective(best_objective))
+    for n in range(1, num_workers + 1):
+        print("    -Best with " + str(n) + " cores: " + describe_placement_objective(best_objective_by_num_workers[n - 1]))
+    print("To get exactly this placement again, set OPTIMISE_TRIAL to " + str(best_trial) + " (and keep OPTIMISE_SEED as " + str(seed) + ")")
+    print("\n")
+
+    if report is not None:
+        report.info['optimise'] = {
+            'seed': seed,
+            'seconds': seconds,
+            'num_workers': num_workers,
+            'num_trials': len(results),
+            'best_trial': best_trial,
+            'objective_names': ['num_places_under_min', 'num_participants_over_max', 'num_unplaced_participants', 'timestamp_unfairness'],
+            'normal_objective': normal_objective,
+            'best_objective': best_objective,
+            'best_objective_by_num_workers': best_objective_by_num_workers,
+        }
+
+    sort_for_trial(df_charities, df_signups, seed, best_trial)
+    return best_trial
+
+# Sorts the dataframes into the order of one particular trial (eg. the best one from an earlier run), without trying any others
+def use_placement_trial(df_charities, df_signups, seed = OPTIMISE_SEED, trial = OPTIMISE_TRIAL, report = None):
+    sort_for_trial(df_charities, df_signups, seed, trial)
+    print("Using the order from trial " + str(trial) + " (seed " + str(seed) + ") instead of optimising")
+    print("\n")
+    if report is not None:
+        report.info['optimise'] = {'seed': seed, 'best_trial': trial, 'replayed': True}
+
+def describe_placement_objective(objective):
+    return str(objective[0]) + " places under min, " + str(objective[1]) + " people over max, " + str(objective[2]) + " participants unplaced (unfairness " + str(round(objective[3], 2)) + ")"
+
+
 # HELPER FUNCTIONS ------------------------------------------------------------------------
 
+# Every print in this file goes through here, so the messages can be collected instead of printed (eg. to send back from the service).
+# Swapping out sys.stdout would do that too, but it's shared by every thread, so anything else printing at the same time would end up in
+# the messages (or the messages would end up printed). This keeps the messages separate for each thread instead
+message_capture = threading.local()
+
+def print(*args, **kwargs):
+    messages = getattr(message_capture, 'messages', None)
+    if messages is not None and kwargs.get('file') is None:
+        kwargs['file'] = messages
+    builtins.print(*args, **kwargs)
+
+# Everything printed inside this goes into the StringIO it gives back instead of being printed
+@contextmanager
+def capture_messages():
+    previous_messages = getattr(message_capture, 'messages', None)
+    message_capture.messages = io.StringIO()
+    try:
+        yield message_capture.messages
+    finally:
+        message_capture.messages = previous_messages
+
 # This code was originally written for placing volunteers in charities, and the column names in the dataframe reflect this.
 # I can't be bothered renaming everything in the code, so I'm just gonna rename the columns here LOL
 def rename_columns_and_fill_empty_ones(df_charities, df_signups):
     if 'further_details' not in df_signups.columns:
         df_signups['further_details'] = ["nan" for i in range(len(df_signups))]
+    # Without timestamps, the order they're in the signups file is the order people signed up in
+    if 'timestamp' not in df_signups.columns:
+        df_signups['timestamp'] = np.arange(len(df_signups))
 
     df_signups.rename(columns = {'further_details': 'further_club_details', 'names': 'volunteer_names', 'preferenced_options': 'chosen_charities'}, inplace = True)
     df_charities.rename(columns = {'place': 'charity'}, inplace = True)
 
 
 # Creates a list of the column names for emails, so it can be edited for different group sizes. For 3, returns ['email_1', 'email_2', 'email_3']
-def get_email_col_names():
-    return ['email_' + str(x + 1) for x in range(MAX_NUM_EMAILS)]
+def get_email_col_names(max_num_emails = None):
+    if max_num_emails is None:
+        max_num_emails = MAX_NUM_EMAILS
+    return ['email_' + str(x + 1) for x in range(max_num_emails)]
 
 # Takes the lists of ids which are assigned to each charity, and assigns them to charities. Does this in-place
-def transform_participant_ids_into_emails(df_charities, df_signups):
-    # Transform the IDs into email lists
-    df_charities['participant_emails'] = [[] for i in range(len(df_charities))]
-    for i in range(len(df_charities)):
-        for signup_id in df_charities.loc[i, 'participant_ids']:
+def transform_participant_ids_into_emails(df_charities, df_signups, report = None, max_num_emails = None):
+    # Check all the placements at once, by looking up each (signup, charity name) pair in the set of (signup, charity name) pairs people
+    # actually picked. The names are turned into numbers first, so each pair is just one number
+    charity_rows = np.repeat(np.arange(len(df_charities)), [len(ids) for ids in df_charities['participant_ids']])
+    placed_ids = np.fromiter(chain.from_iterable(df_charities['participant_ids']), dtype = np.int64, count = len(charity_rows))
+    placed_charities = df_charities['charity'].to_numpy()[charity_rows]
+
+    place_names = pd.Index(df_charities['charity'].unique())
+    num_picks = df_signups['charity_list'].str.len().to_numpy() if len(df_signups) > 0 else np.zeros(0, dtype = np.int64)
+    picked_ids = np.repeat(np.arange(len(df_signups), dtype = np.int64), num_picks)
+    picked_codes = place_names.get_indexer(np.fromiter(chain.from_iterable(df_signups['charity_list']), dtype = object, count = int(num_picks.sum())))
+    placed_codes = place_names.get_indexer(placed_charities)
+    is_valid = np.isin(placed_ids * (len(place_names) + 1) + placed_codes, picked_ids * (len(place_names) + 1) + picked_codes)
+
+    if report is not None:
+        report.counters['misassignment_checks'] += len(placed_ids)
+    for signup_id, charity_name in zip(placed_ids[~is_valid], placed_charities[~is_valid]): # To check my code hasn't broken
+        if report is not None:
+            report.counters['misassignments_found'] += 1
+        print("The code has broken somewhere lol")
+        print("Misassiged placement: ID " + str(signup_id) + " with place " + charity_name)
 
-            if (df_charities.loc[i, 'charity'] not in df_signups.loc[signup_id, 'charity_list']): # To check my code hasn't broken
-                print("The code has broken somewhere lol")
-                print("Misassiged placement: ID " + str(signup_id) + " with place " + df_charities.loc[i, 'charity'])
-
-            df_charities.at[i, 'participant_emails'] = df_charities.at[i, 'participant_emails'] + df_signups.at[signup_id, 'participant_emails']
+    # Transform the IDs into email lists
+    signup_emails = get_signup_emails(df_signups, max_num_emails)
+    df_charities['participant_emails'] = [signup_emails.get_joined(signup_ids) for signup_ids in df_charities['participant_ids']]
 
     # Formatting the emails of participants in a way that's easy to just copy paste into outlook
-    df_charities['participant_emails_as_string'] = ''
-    for i in range(len(df_charities)):
-        df_charities.at[i, 'participant_emails_as_string'] = "; ".join(df_charities.at[i, 'participant_emails'])
+    df_charities['participant_emails_as_string'] = ["; ".join(emails) for emails in df_charities['participant_emails']]
 
 
 # Creating a dataframe with the info of everyone the algorithm couldn't place
-def generate_dataframe_of_unassignable_people(too_late_signups_list, ids_with_no_existing_options, df_signups):
+def generate_dataframe_of_unassignable_people(too_late_signups_list, ids_with_no_existing_options, df_signups, too_late_reason, max_num_emails = None):
     all_unassignable_people = ids_with_no_existing_options + too_late_signups_list
+    signup_emails = get_signup_emails(df_signups, max_num_emails)
 
     df_unable_to_be_placed = pd.DataFrame()
     df_unable_to_be_placed['internal_code_id'] = all_unassignable_people
     df_unable_to_be_placed['emails'] = [[] for i in range(len(all_unassignable_people))]
     df_unable_to_be_placed['picked_options'] = [[] for i in range(len(all_unassignable_people))]
     for i in range(len(df_unable_to_be_placed)):
-        df_unable_to_be_placed.at[i, 'emails'] = df_signups.at[all_unassignable_people[i], 'participant_emails']
+        df_unable_to_be_placed.at[i, 'emails'] = signup_emails[all_unassignable_people[i]].tolist()
         df_unable_to_be_placed.at[i, 'picked_options'] = df_signups.at[all_unassignable_people[i], 'charity_list']
     df_unable_to_be_placed = df_unable_to_be_placed.loc[:, ['emails', 'picked_options']]
 
     reason = ["None of the options this group chose were valid (ie. existed in the list of charities)" for i in range(len(ids_with_no_existing_options))]
-    reason = reason + ["All of the options this group chose were full, and they were the most recent signup and so get lowest priority" for i in range(len(too_late_signups_list))]
+    reason = reason + [too_late_reason for i in range(len(too_late_signups_list))]
     df_unable_to_be_placed['reason'] = reason
 
     return df_unable_to_be_placed
 
 # A function to get the list of emails of people who wanted further details for each of the given charity clubs
-def get_further_details_email_lists(df_signups):
-
-    # Initialise a defaultdict for empty lists
-    emails_lists = defaultdict(list)
-
-    # For each signup in the list, split their list of clubs to find more info about, then add them to the list of emails for that club
-    for i in range(len(df_signups)):
-        emails_lists['All emails'] = emails_lists['All emails'] + df_signups.at[i, 'participant_emails']
-        clubs = str(df_signups.at[i, 'further_club_details']).split(',')
+def get_further_details_email_lists(df_signups, max_num_emails = None):
+
+    # Go through the signups once and note down which signups want the emails for each club (plus everyone for 'All emails'). Each list of
+    # emails then only gets put together once at the end, instead of being copied every time someone is added to it
+    signup_ids_by_club = defaultdict(list)
+    for signup_id, further_club_details in enumerate(df_signups['further_club_details'].tolist()):
+        signup_ids_by_club['All emails'].append(signup_id)
+        clubs = str(further_club_details).split(',')
         for club in clubs:
-            club = club.strip()
-            emails_lists[club] = emails_lists[club] + df_signups.at[i, 'participant_emails']
+            signup_ids_by_club[club.strip()].append(signup_id)
 
     # Remove the signups who didn't want any further information
-    if "nan" in emails_lists.keys():
-        emails_lists.pop("nan")
+    signup_ids_by_club.pop("nan", None)
 
     # Transform the lists into a string of emails which are easy to just copy paste
-    for key in emails_lists.keys():
-        emails_lists[key] = '; '.join(emails_lists[key])
+    signup_emails = get_signup_emails(df_signups, max_num_emails)
+    emails_lists = {club: '; '.join(signup_emails.get_joined(signup_ids)) for club, signup_ids in signup_ids_by_club.items()}
 
     return pd.DataFrame(sorted(emails_lists.items()))
 
 
-# Save the outputs, or return an easier-to-read error message if we can't open the file
-def save_dataframes_as_excel(df_charities, df_unable_to_be_placed, df_repeated_emails, df_emails_for_each_club_further_info):
+# READING AND SAVING FILES ----------------------------------------------------------------
+# Excel is the default since that's what most people will have, but reading and writing big excel files is slow (often slower than the actual placing),
+# so the inputs can also be .csv or .parquet files, and the outputs can be saved as a separate .csv or .parquet file for each sheet
+
+# Works out whether a file is excel, csv or parquet from its extension, unless we've been told which it is
+def get_file_format(filepath, file_format = None):
+    if file_format is not None:
+        return file_format
+
+    suffix = Path(filepath).suffix.lower()
+    if suffix in ['.xlsx', '.xlsm', '.xls']:
+        return "xlsx"
+    if suffix == '.csv':
+        return "csv"
+    if suffix in ['.parquet', '.pq']:
+        return "parquet"
+    raise ValueError("Couldn't tell what type of file " + str(filepath) + " is. It should be an excel (.xlsx), .csv or .parquet file")
+
+# The columns we actually use from each input file, and what type they should be. Anything else in the files (like names) doesn't get read at all
+def get_places_dtypes():
+    return {'place': str, 'min_number': np.int64, 'max_number': np.int64}
+
+def get_signups_dtypes(max_num_emails = None):
+    dtypes = {col_name: str for col_name in get_email_col_names(max_num_emails)}
+    dtypes['preferenced_options'] = str
+    dtypes['further_details'] = str
+    return dtypes
+
+def read_input_file(filepath, dtypes, date_col_names = [], file_format = INPUT_FORMAT):
+    file_format = get_file_format(filepath, file_format)
+    col_names = list(dtypes) + date_col_names
+
+    if file_format == "xlsx":
+        return pd.read_excel(filepath, usecols = lambda col_name: col_name in col_names, dtype = dtypes) # Excel already knows which cells are dates
+    elif file_format == "csv":
+        df = pd.read_csv(filepath, usecols = lambda col_name: col_name in col_names, dtype = dtypes)
+        for col_name in date_col_names:
+            if col_name in df.columns: # parse_dates would fail if the column isn't there
+                df[col_name] = pd.to_datetime(df[col_name])
+        return df
+    elif file_format == "parquet":
+        import pyarrow.parquet # Only needed for parquet files, so only imported if you're using them
+        available_col_names = pyarrow.parquet.read_schema(filepath).names
+        df = pd.read_parquet(filepath, columns = [col_name for col_name in col_names if col_name in available_col_names])
+        # Parquet files already have types, so only the numbers might need converting (converting text would turn empty cells into "None")
+        return df.astype({col_name: dtype for col_name, dtype in dtypes.items() if col_name in df.columns and dtype is not str})
+    else:
+        raise ValueError("Unknown file format '" + str(file_format) + "', this should be 'xlsx', 'csv' or 'parquet'")
+
+# Puts together each of the tables in the output, with the name of the sheet it goes in
+def get_output_sheets(df_charities, df_unable_to_be_placed, df_repeated_emails, df_emails_for_each_club_further_info, df_changes = None):
     df_charities_output = df_charities.loc[:, ['charity', 'min_number', 'max_number', 'participant_count', 'participant_emails_as_string']]
     df_charities_output.rename(columns = {'charity': 'place'},inplace = True)
 
+    output_sheets = {
+        "Repeated Emails": df_repeated_emails,
+        "Unassignable People": df_unable_to_be_placed,
+        "Places & Assigned Emails": df_charities_output,
+        "Addresses for Further Details": df_emails_for_each_club_further_info,
+    }
+    if df_changes is not None:
+        output_sheets["Changes Since Last Run"] = df_changes
+
+    return output_sheets
+
+def save_dataframes(df_charities, df_unable_to_be_placed, df_repeated_emails, df_emails_for_each_club_further_info, df_changes = None, output_format = OUTPUT_FORMAT, output_path = PATH):
+    output_sheets = get_output_sheets(df_charities, df_unable_to_be_placed, df_repeated_emails, df_emails_for_each_club_further_info, df_changes)
+    if output_format == "xlsx":
+        save_dataframes_as_excel(output_sheets, output_path)
+    else:
+        save_dataframes_as_separate_files(output_sheets, output_format, output_path)
+
+# Save the outputs, or return an easier-to-read error message if we can't open the file
+def save_dataframes_as_excel(output_sheets, output_path = PATH):
     try:
-        with pd.ExcelWriter(PATH.joinpath("placements_output.xlsx")) as writer:
-            df_repeated_emails.to_excel(writer, "Repeated Emails")
-            df_unable_to_be_placed.to_excel(writer, "Unassignable People")
-            df_charities_output.to_excel(writer, "Places & Assigned Emails")
-            df_emails_for_each_club_further_info.to_excel(writer, "Addresses for Further Details")
+        with pd.ExcelWriter(Path(output_path).joinpath("placements_output.xlsx")) as writer:
+            for sheet_name, df in output_sheets.items():
+                df.to_excel(writer, sheet_name = sheet_name)
     except:
         print("ERROR")
         print("The program successfully ran, but couldn't save the output. This is probably because you still have the excel file open. Please try again")
 
-# RUNNING CODE ----------------------------------------------------------------------------
+# Saves each sheet as its own file, eg. "Places & Assigned Emails" goes in placements_output_places_assigned_emails.csv
+def save_dataframes_as_separate_files(output_sheets, output_format, output_path = PATH):
+    for sheet_name, df in output_sheets.items():
+        filepath = Path(output_path).joinpath(get_output_filename(sheet_name, output_format))
+        try:
+            if output_format == "csv":
+                df.to_csv(filepath, index = False)
+            elif output_format == "parquet":
+                df.rename(columns = str).to_parquet(filepath, index = False) # Parquet needs the column names to be text
+            else:
+                raise ValueError("Unknown output format '" + str(output_format) + "', this should be 'xlsx', 'csv' or 'parquet'")
+        except PermissionError:
+            print("ERROR")
+            print("The program successfully ran, but couldn't save " + str(filepath) + ". This is probably because you still have it open. Please try again")
+
+def get_output_filename(sheet_name, output_format):
+    return "placements_output_" + re.sub('[^a-z0-9]+', '_', sheet_name.lower()).strip('_') + "." + output_format
+
+# CACHING INPUTS BETWEEN RUNS ------------------------------------------------------------
+# The usual way of using this is to run it, read the messages about repeated emails or places that don't exist, fix one of the files and run
+# it again. Reading excel files (and preprocessing big ones) is slow, so the inputs get saved in CACHE_PATH after they've been read and
+# preprocessed, and reused next time if the files haven't changed. Everything in there is looked up by a hash of what's in the files (so
+# re-saving a file without changing it doesn't matter), the settings that affect it and a hash of this code, so a saved copy never gets used
+# when it would've come out differently. Each input file gets saved by itself after being read, so if only one file changed the other one
+# doesn't need to be read again, and the preprocessed places and signups get saved together along with the messages printed while
+# preprocessing them (so you still see all the warnings)
+
+class InputCache:
+    def __init__(self, cache_path = CACHE_PATH, max_mb = CACHE_MAX_MB):
+        self.cache_path = Path(cache_path)
+        self.max_bytes = max_mb * 1024 * 1024
+
+    def get_filepath(self, key):
+        return self.cache_path.joinpath(key + ".pkl")
+
+    # Returns the saved value, or None if there isn't one
+    def get(self, key):
+        filepath = self.get_filepath(key)
+        try:
+            with open(filepath, 'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception: # Broken somehow (eg. saved by a different version of pandas), so just read the file again instead
+            filepath.unlink(missing_ok = True)
+            return None
+
+        os.utime(filepath) # Mark it as recently used, so it's the last thing to get deleted
+        return value
+
+    def put(self, key, value):
+        temp_filepath = self.cache_path.joinpath(key + "." + str(os.getpid()) + ".tmp")
+        try:
+            self.cache_path.mkdir(parents = True, exist_ok = True)
+            with open(temp_filepath, 'wb') as f:
+                pickle.dump(value, f, protocol = pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_filepath, self.get_filepath(key)) # So nothing ever reads a half-saved file (eg. another event in batch mode)
+        except OSError as error:
+            temp_filepath.unlink(missing_ok = True)
+            print("Couldn't save to the cache in " + str(self.cache_path) + " (" + str(error) + "), so the next run won't be any quicker")
+            return
+        self.evict()
+
+    # Deletes the least recently used files until the cache is under max_mb again
+    def evict(self):
+        cached_files = []
+        for filepath in self.cache_path.glob("*.pkl"):
+            try:
+                file_stats = filepath.stat()
+            except FileNotFoundError: # Another process (eg. in batch mode) just deleted it
+                continue
+            cached_files.append((file_stats.st_mtime, file_stats.st_size, filepath))
+
+        total_size = sum(size for _, size, _ in cached_files)
+        for _, size, filepath in sorted(cached_files):
+            if total_size <= self.max_bytes:
+                break
+            filepath.unlink(missing_ok = True)
+            total_size -= size
+
+# Hashes what's in a file, a chunk at a time so big files don't need to fit in memory
+def hash_file(filepath):
+    file_hash = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+# The key something is saved under in the cache, made from everything that could change it. This code and the version of pandas are always
+# part of it, so changing the code (or updating pandas) never uses something saved by the old version
+def get_cache_key(**parts):
+    parts['code'] = hash_file(__file__)
+    parts['pandas'] = pd.__version__
+    return hashlib.sha256(json.dumps(parts, sort_keys = True, default = str).encode()).hexdigest()
+
+# read_input_file, but reusing the copy saved in the cache if the file hasn't changed since it was last read. cache can be None to not use it
+def read_input_file_using_cache(filepath, dtypes, date_col_names = [], cache = None, file_hash = None):
+    if cache is None:
+        return read_input_file(filepath, dtypes, date_col_names)
+
+    file_format = get_file_format(filepath, INPUT_FORMAT)
+    key = get_cache_key(kind = "input_file", file = file_hash or hash_file(filepath), file_format = file_format, dtypes = dtypes, date_col_names = date_col_names)
+    df = cache.get(key)
+    if df is not None:
+        print("Using the copy of " + str(filepath) + " saved in the cache, since it hasn't changed since it was last read")
+        return df
+
+    df = read_input_file(filepath, dtypes, date_col_names, file_format)
+    cache.put(key, df)
+    return df
+
+# The hash of the place aliases file if it'll be used in preprocessing, otherwise None
+def get_place_aliases_hash(config):
+    if not config.resolve_place_names or config.place_aliases_filepath is None or not Path(config.place_aliases_filepath).exists():
+        return None
+    return hash_file(config.place_aliases_filepath)
+
+# Reads both inputs and preprocesses them (everything before sorting), using the cache for whatever hasn't changed. Returns the places,
+# signups and repeated emails, the same as reading them and calling preprocess_inputs
+def read_and_preprocess_inputs(places_filepath, signups_filepath, config, report, cache = None):
+    if cache is None:
+        with report.phase("read"):
+            df_charities = read_input_file(places_filepath, get_places_dtypes())
+            df_signups = read_input_file(signups_filepath, get_signups_dtypes(config.max_num_emails), ['timestamp'])
+        df_repeated_emails = preprocess_inputs(df_charities, df_signups, config, report, places_filepath)
+        return df_charities, df_signups, df_repeated_emails
+
+    with report.phase("read"):
+        places_hash = hash_file(places_filepath)
+        signups_hash = hash_file(signups_filepath)
+        place_aliases_hash = get_place_aliases_hash(config)
+        # The file paths are part of it too, since they're in the messages
+        key = get_cache_key(kind = "preprocessed_inputs", places = places_hash, signups = signups_hash, place_aliases = place_aliases_hash, places_filepath = places_filepath,
+            place_aliases_filepath = config.place_aliases_filepath, input_format = INPUT_FORMAT, max_num_emails = config.max_num_emails, resolve_place_names = config.resolve_place_names,
+            save_place_alias_suggestions = config.save_place_alias_suggestions)
+        preprocessed_inputs = cache.get(key)
+
+    if preprocessed_inputs is not None:
+        report.info['used_cached_preprocessing'] = True
+        print("Using the preprocessed places and signups saved in the cache, since neither file has changed since they were last read. The messages from preprocessing them were:")
+        print("\n")
+        print(preprocessed_inputs['messages'], end = '')
+        return preprocessed_inputs['df_charities'], preprocessed_inputs['df_signups'], preprocessed_inputs['df_repeated_emails']
 
-def run_generator():
-    # Read the dataframes
-    df_charities = pd.read_excel(PLACES_FILEPATH) # TODO: Change to df_places for extensibility # TODO Amend so this is more extensible and expects the name "place", or just rename this column at start lols
-    df_signups = pd.read_excel(SIGNUPS_FILEPATH)
+    with report.phase("read"):
+        df_charities = read_input_file_using_cache(places_filepath, get_places_dtypes(), [], cache, places_hash)
+        df_signups = read_input_file_using_cache(signups_filepath, get_signups_dtypes(config.max_num_emails), ['timestamp'], cache, signups_hash)
 
+    # The messages still get printed, just once preprocessing is done (or fails)
+    try:
+        with capture_messages() as messages:
+            df_repeated_emails = preprocess_inputs(df_charities, df_signups, config, report, places_filepath)
+    finally:
+        print(messages.getvalue(), end = '')
+
+    # If new suggestions just got added to the aliases file, next time it'll be looked up with the new aliases file anyway
+    report.info['used_cached_preprocessing'] = False
+    if get_place_aliases_hash(config) == place_aliases_hash:
+        cache.put(key, {'df_charities': df_charities, 'df_signups': df_signups, 'df_repeated_emails': df_repeated_emails, 'messages': messages.getvalue()})
+
+    return df_charities, df_signups, df_repeated_emails
+
+
+# RUN REPORT ------------------------------------------------------------------------------
+# When a run is slow or leaves lots of people unplaced, the printed messages don't tell you much about why. This keeps track of how long
+# each step took and what the solver got up to (how many people got placed straight away, how many got bumped, how deep the bumping went etc.)
+# and saves it as JSON next to the output
+
+class RunReport:
+    def __init__(self):
+        self.phase_seconds = {}
+        self.counters = defaultdict(int)
+        self.info = {}
+
+    # Use as "with report.phase('sort'):" to time everything inside it
+    @contextmanager
+    def phase(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phase_seconds[name] = self.phase_seconds.get(name, 0) + time.perf_counter() - start_time
+
+    # Adds up how the placing went, once everything's been assigned
+    def record_results(self, df_charities, df_signups, df_unassignable_people):
+        self.info['num_signups'] = len(df_signups)
+        self.info['num_places'] = len(df_charities)
+        self.info['num_participants'] = int(df_signups['num_participants'].sum())
+        self.info['num_placed_participants'] = int(df_charities['participant_count'].sum())
+        self.info['fill_rate'] = self.info['num_placed_participants'] / max(self.info['num_participants'], 1)
+        self.info['num_unplaced_groups'] = len(df_unassignable_people)
+        self.info['num_places_under_min'] = int((df_charities['participant_count'] < df_charities['min_number']).sum())
+        self.info['num_places_over_max'] = int((df_charities['participant_count'] > df_charities['max_number']).sum())
+
+    def to_dict(self):
+        return {
+            'info': self.info,
+            'phase_seconds': self.phase_seconds,
+            'total_seconds': sum(self.phase_seconds.values()),
+            'solver_counters': {name: int(count) for name, count in self.counters.items()},
+        }
+
+    def save(self, filepath):
+        with open(filepath, 'w') as f:
+            json.dump(self.to_dict(), f, indent = 4, default = str)
+
+
+# BATCH MODE (LOTS OF EVENTS AT ONCE) -------------------------------------------------------
+# If you're running a Day of Good at lots of campuses/chapters, instead of copying this code for each one you can run them all at once:
+#     python "Group Generator for Day of Good v2.py" batch events_folder
+# where events_folder has a folder for each event, each with its own places_input and signups_input file (.xlsx, .csv or .parquet). The outputs
+# and a log of the messages for each event get saved in that event's folder. Or, instead of a folder you can give a manifest .csv (or .xlsx) file
+# with the columns "event", "places" and "signups" (and optionally "output"), with the file paths relative to where the manifest is.
+# The events are run at the same time on different CPU cores, and if one of them breaks the rest still run. A summary of how each event went
+# is saved as batch_summary.csv
+
+# Works out the list of events to run from a folder or manifest file. Each event is a dict with its name, input files and output folder
+def find_batch_events(batch_path):
+    batch_path = Path(batch_path)
+    events = []
+
+    if batch_path.is_dir():
+        for event_path in sorted(batch_path.iterdir()):
+            if not event_path.is_dir():
+                continue
+            places_filepaths = find_input_files(event_path, "places_input")
+            signups_filepaths = find_input_files(event_path, "signups_input")
+            if len(places_filepaths) == 0 and len(signups_filepaths) == 0:
+                continue # Just some other folder
+            events.append({
+                'event': event_path.name,
+                'places_filepath': places_filepaths[0] if len(places_filepaths) > 0 else event_path.joinpath("places_input.xlsx"),
+                'signups_filepath': signups_filepaths[0] if len(signups_filepaths) > 0 else event_path.joinpath("signups_input.xlsx"),
+                'output_path': event_path,
+            })
+    else:
+        df_manifest = read_table_file(batch_path)
+        for i in range(len(df_manifest)):
+            output_path = df_manifest.at[i, 'output'] if 'output' in df_manifest.columns and type(df_manifest.at[i, 'output']) == str else str(df_manifest.at[i, 'event'])
+            events.append({
+                'event': str(df_manifest.at[i, 'event']),
+                'places_filepath': batch_path.parent.joinpath(df_manifest.at[i, 'places']),
+                'signups_filepath': batch_path.parent.joinpath(df_manifest.at[i, 'signups']),
+                'output_path': batch_path.parent.joinpath(output_path),
+            })
+
+    return events
+
+# Reads a small settings table (like a batch manifest or what-if scenarios) from a .csv or excel file
+def read_table_file(filepath):
+    if get_file_format(filepath) == "xlsx":
+        return pd.read_excel(filepath)
+    return pd.read_csv(filepath)
+
+# Finds eg. places_input.xlsx/.csv/.parquet in a folder (ignoring the temporary ~$ files excel makes when a file is open)
+def find_input_files(folder_path, name):
+    return sorted(filepath for filepath in folder_path.glob(name + ".*") if filepath.suffix.lower() in ['.xlsx', '.xlsm', '.xls', '.csv', '.parquet', '.pq'])
+
+# Runs one event inside a worker process. All the messages go to a log file in the event's output folder instead of the screen (since they'd all
+# be jumbled together otherwise), and any errors get caught so the other events keep going
+def run_batch_event(event, use_cache = USE_CACHE):
+    import contextlib
+    import traceback
+
+    summary = {'event': event['event'], 'status': "failed", 'output_path': str(event['output_path'])}
+    start_time = time.perf_counter()
+    try:
+        Path(event['output_path']).mkdir(parents = True, exist_ok = True)
+        with open(Path(event['output_path']).joinpath("placements_log.txt"), 'w') as log_file, contextlib.redirect_stdout(log_file):
+            try:
+                report = run_generator(event['places_filepath'], event['signups_filepath'], event['output_path'], Path(event['output_path']).joinpath(PREVIOUS_PLACEMENTS_FILEPATH.name), use_cache)
+            except Exception:
+                print(traceback.format_exc())
+                raise
+        summary['status'] = "ok"
+        for name in ['num_signups', 'num_participants', 'num_placed_participants', 'fill_rate', 'num_unplaced_groups', 'num_places_under_min', 'num_places_over_max']:
+            summary[name] = report.info.get(name)
+    except Exception as error:
+        summary['error'] = type(error).__name__ + ": " + str(error)
+    summary['seconds'] = time.perf_counter() - start_time
+    return summary
+
+def run_batch(batch_path, num_workers = None, use_cache = USE_CACHE):
+    from concurrent.futures import ProcessPoolExecutor
+
+    events = find_batch_events(batch_path)
+    print("Found " + str(len(events)) + " events to run in " + str(batch_path))
+
+    summaries = []
+    with ProcessPoolExecutor(max_workers = num_workers) as executor:
+        futures = [executor.submit(run_batch_event, event, use_cache) for event in events]
+        for event, future in zip(events, futures):
+            try:
+                summary = future.result()
+            except Exception as error: # The worker process itself died, eg. ran out of memory
+                summary = {'event': event['event'], 'status': "failed", 'output_path': str(event['output_path']), 'error': type(error).__name__ + ": " + str(error)}
+            summaries.append(summary)
+
+            if summary['status'] == "ok":
+                print("    -" + summary['event'] + ": placed " + str(summary['num_placed_participants']) + " out of " + str(summary['num_participants']) + " participants, " + str(summary['num_unplaced_groups']) + " groups couldn't be placed")
+            else:
+                print("    -" + summary['event'] + ": FAILED (" + summary.get('error', "") + "), see the placements_log.txt in its folder")
+
+    summary_col_names = ['event', 'status', 'num_signups', 'num_participants', 'num_placed_participants', 'fill_rate', 'num_unplaced_groups', 'num_places_under_min', 'num_places_over_max', 'seconds', 'output_path', 'error']
+    df_summary = pd.DataFrame(summaries).reindex(columns = summary_col_names)
+    summary_folder = Path(batch_path) if Path(batch_path).is_dir() else Path(batch_path).parent
+    df_summary.to_csv(summary_folder.joinpath("batch_summary.csv"), index = False)
+    print("Summary saved to " + str(summary_folder.joinpath("batch_summary.csv")))
+
+    return df_summary
+
+
+# USING IT FROM OTHER CODE (LIBRARY AND LOCAL SERVICE) ---------------------------------------
+# Other programs (eg. a signup website) can use the generator without going through files. generate_placements takes the places and signups
+# as dataframes or lists of dicts (with the same columns as the input files) and gives back the results, without printing anything or
+# waiting for enter to be pressed. The messages it would've printed are in the results instead (collected separately for each thread, so it's
+# fine to call it from several threads at once). To use it from Python:
+#     generator = importlib.import_module("Group Generator for Day of Good v2")
+#     results = generator.generate_placements(places, signups, generator.GeneratorConfig(solver = "flow"))
+# Or run it as a local service with "python "Group Generator for Day of Good v2.py" serve", which keeps everything loaded (including the places)
+# between requests so each placement only takes milliseconds:
+#     GET  /health      -> {"status": "ok", "num_places": ...}
+#     POST /places      with {"places": [...]}, to change the places the service remembers
+#     POST /placements  with {"signups": [...]}, plus "places" to use different places just this once and "config" to change settings
+#                       (eg. {"solver": "flow"}). Returns the same results as generate_placements, as JSON
+
+# Returns a dict with 'placements' (each place, how many people are in it and their emails), 'unassignable', 'repeated_emails',
+# 'further_details' (the emails for each club), 'report' (the run report as a dict) and 'messages' (everything that would've been printed)
+def generate_placements(places, signups, config = None):
+    if config is None:
+        config = GeneratorConfig()
+    df_charities = make_input_dataframe(places, get_places_dtypes())
+    df_signups = make_input_dataframe(signups, get_signups_dtypes(config.max_num_emails), ['timestamp'])
+    report = RunReport()
+
+    with capture_messages() as messages:
+        outputs = process_signups(df_charities, df_signups, config, report, "the places given")
+
+    df_placements = outputs['df_charities'].loc[:, ['charity', 'min_number', 'max_number', 'participant_count', 'participant_emails']]
+    df_placements.rename(columns = {'charity': 'place', 'participant_emails': 'emails'}, inplace = True)
+    df_further_details = outputs['df_emails_for_each_club_further_info'].set_axis(['club', 'emails'], axis = 1) if len(outputs['df_emails_for_each_club_further_info']) > 0 else pd.DataFrame(columns = ['club', 'emails'])
+
+    return {
+        'placements': df_placements,
+        'unassignable': outputs['df_unassignable_people'],
+        'repeated_emails': outputs['df_repeated_emails'],
+        'further_details': df_further_details,
+        'report': report.to_dict(),
+        'messages': messages.getvalue(),
+    }
+
+# Makes a copy of the dataframe (or turns the list of dicts into one) with the same types as when it's read from a file. Email columns which
+# aren't there (eg. if nobody was in a group) are added as empty, and so is everything else if there aren't any rows at all (an empty list
+# has no columns). The index is reset, since everything after this expects rows numbered 0, 1, 2... like a file (eg. for the line numbers)
+def make_input_dataframe(data, dtypes, date_col_names = []):
+    df = data.copy() if isinstance(data, pd.DataFrame) else pd.DataFrame.from_records(list(data))
+    df = df.reset_index(drop = True)
+    for col_name in dtypes:
+        if col_name.startswith('email_') and col_name not in df.columns:
+            df[col_name] = np.nan
+        elif len(df) == 0 and col_name not in df.columns:
+            df[col_name] = pd.Series(dtype = object) # Text, like it would be if it was read from a file with no rows
+    # Only the numbers need converting (converting text would turn empty cells into "nan" on older versions of pandas)
+    df = df.astype({col_name: dtype for col_name, dtype in dtypes.items() if col_name in df.columns and dtype is not str})
+    for col_name in date_col_names:
+        if col_name in df.columns:
+            df[col_name] = pd.to_datetime(df[col_name])
+    return df
+
+# Turns the results from generate_placements into JSON
+def placement_results_to_json(results):
+    results = {name: result.to_dict('records') if isinstance(result, pd.DataFrame) else result for name, result in results.items()}
+    return json.dumps(results, default = str)
+
+class PlacementServiceHandler(BaseHTTPRequestHandler):
+    df_places = None # The places are kept here between requests, so they only need to be read once
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {'status': "ok", 'num_places': 0 if self.df_places is None else len(self.df_places)})
+        else:
+            self.send_json(404, {'error': "Unknown path " + self.path})
+
+    def do_POST(self):
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b"{}")
+            if self.path == "/places":
+                PlacementServiceHandler.df_places = make_input_dataframe(body['places'], get_places_dtypes())
+                self.send_json(200, {'status': "ok", 'num_places': len(self.df_places)})
+            elif self.path == "/placements":
+                places = body['places'] if 'places' in body else self.df_places
+                if places is None:
+                    self.send_json(400, {'error': "No places have been loaded. Send them with the request, or to /places first"})
+                    return
+                results = generate_placements(places, body['signups'], self.make_config(body.get('config', {})))
+                self.send_json(200, placement_results_to_json(results))
+            else:
+                self.send_json(404, {'error': "Unknown path " + self.path})
+        except (KeyError, TypeError, ValueError) as error: # Something wrong with the request
+            self.send_json(400, {'error': type(error).__name__ + ": " + str(error)})
+        except Exception as error:
+            self.send_json(500, {'error': type(error).__name__ + ": " + str(error)})
+
+    # Only these settings can be changed by a request. The rest (eg. file paths and the optimiser's workers) would let anyone who can reach
+    # the service read or write files, or tie up the computer, so they have to be set in the code instead
+    request_settings = {'solver': str, 'max_recursions': int, 'max_num_emails': int}
+
+    def make_config(self, settings):
+        if not isinstance(settings, dict):
+            raise ValueError("config has to be an object of settings")
+        for name, value in settings.items():
+            if name not in self.request_settings:
+                raise ValueError("The setting " + str(name) + " can't be changed in a request. Only these can: " + ", ".join(self.request_settings))
+            if type(value) is not self.request_settings[name]:
+                raise ValueError("The setting " + name + " has the wrong type (it has to be " + self.request_settings[name].__name__ + ")")
+        if settings.get('solver', SOLVER) not in ("heuristic", "flow"):
+            raise ValueError("solver has to be \"heuristic\" or \"flow\"")
+        if settings.get('max_recursions', 0) < 0 or settings.get('max_num_emails', 1) < 1:
+            raise ValueError("max_recursions can't be negative, and max_num_emails has to be at least 1")
+        return GeneratorConfig(**settings)
+
+    # data can be a dict, or something that's already been turned into JSON
+    def send_json(self, status, data):
+        body = (data if isinstance(data, str) else json.dumps(data, default = str)).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', "application/json")
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+# Runs the service until it's stopped with Ctrl-C. It only handles one request at a time, so placements can't get mixed up with each other
+def run_service(places_filepath = PLACES_FILEPATH, host = "127.0.0.1", port = 8765):
+    if places_filepath is not None and Path(places_filepath).exists():
+        PlacementServiceHandler.df_places = read_input_file(places_filepath, get_places_dtypes())
+        print("Loaded " + str(len(PlacementServiceHandler.df_places)) + " places from " + str(places_filepath))
+    else:
+        print("No places loaded yet, send them to /places (or with each request)")
+
+    server = HTTPServer((host, port), PlacementServiceHandler)
+    print("Placement service running at http://" + host + ":" + str(server.server_port) + " (press Ctrl-C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# WHAT-IF SCENARIOS (TRYING DIFFERENT CAPACITIES) ----------------------------------------------
+# To work out how many spots to ask each place for, instead of changing min_number/max_number and rerunning again and again, you can try lots
+# of scenarios at once:
+#     python "Group Generator for Day of Good v2.py" whatif --capacity-scale 0.8 1 1.2 --max-recursions 20 50 --sort-policy ratio signup_time
+# runs every combination of those, or "--scenarios scenarios.csv" runs the scenarios listed in a file. That file has a "scenario" column with
+# the name of each scenario, and any of these (blank means the same as normal):
+#     capacity_scale, max_recursions, sort_policy, solver     which apply to the whole scenario
+#     place, min_number, max_number                            to change one place's numbers (use one row for each place you're changing)
+# The inputs only get read and preprocessed once, then each scenario gets placed (on all the CPU cores at once) and the fill rate, unplaced
+# groups and places under their minimum for each are saved to whatif_comparison.csv. Nothing else gets saved
+
+# "ratio" is the normal sorting, "signup_time" still sorts the places normally but places people first come first served, and "input_order"
+# doesn't sort anything (everything's placed in the order it's in the input files)
+SORT_POLICIES = ["ratio", "signup_time", "input_order"]
+
+shared_scenario_data = {} # The preprocessed places and signups, set up once in each worker process
+
+# Reads and preprocesses the inputs exactly like a normal run does, up to (but not including) sorting, so it uses the same cache as a normal
+# run too. The scenarios don't need the repeated emails or a run report, so those get thrown away
+def prepare_scenario_data(places_filepath, signups_filepath, config, cache = None):
+    df_charities, df_signups, df_repeated_emails = read_and_preprocess_inputs(places_filepath, signups_filepath, config, RunReport(), cache)
+    return df_charities, df_signups
+
+# Makes the list of scenarios from the scenarios file (if there is one) and every combination of the grid options. Each scenario is a dict
+def get_scenarios(df_charities, scenarios_filepath = None, capacity_scales = None, max_recursions_list = None, sort_policies = None, solvers = None, config = None):
+    if config is None:
+        config = GeneratorConfig()
+    default_scenario = {'capacity_scale': 1.0, 'max_recursions': config.max_recursions, 'sort_policy': "ratio", 'solver': config.solver, 'capacity_changes': {}}
+    scenarios = [dict(default_scenario, scenario = "as is")]
+
+    if scenarios_filepath is not None:
+        place_name_index = PlaceNameIndex(df_charities['charity'])
+        df_scenarios = read_table_file(scenarios_filepath)
+        for scenario_name, df_scenario in df_scenarios.groupby(df_scenarios['scenario'].astype(str), sort = False):
+            scenario = dict(default_scenario, scenario = scenario_name, capacity_changes = {})
+            for setting, cast in [('capacity_scale', float), ('max_recursions', int), ('sort_policy', str), ('solver', str)]:
+                if setting in df_scenario.columns and df_scenario[setting].notna().any():
+                    scenario[setting] = cast(df_scenario[setting].dropna().iloc[0])
+
+            if 'place' in df_scenario.columns:
+                for row in df_scenario[df_scenario['place'].notna()].to_dict('records'):
+                    place_name = place_name_index.find(row['place'])
+                    if place_name is None:
+                        print("The place '" + str(row['place']) + "' in scenario '" + scenario_name + "' isn't in the places input, so it's been ignored")
+                        continue
+                    scenario['capacity_changes'][place_name] = (row.get('min_number'), row.get('max_number'))
+            scenarios.append(scenario)
+
+    if any(options is not None for options in [capacity_scales, max_recursions_list, sort_policies, solvers]):
+        for capacity_scale in capacity_scales or [1.0]:
+            for max_recursions in max_recursions_list or [config.max_recursions]:
+                for sort_policy in sort_policies or ["ratio"]:
+                    for solver in solvers or [config.solver]:
+                        scenario_name = "scale " + str(capacity_scale) + ", max_recursions " + str(max_recursions) + ", " + sort_policy + ", " + solver
+                        scenarios.append(dict(default_scenario, scenario = scenario_name, capacity_scale = capacity_scale, max_recursions = max_recursions, sort_policy = sort_policy, solver = solver))
+
+    for scenario in scenarios:
+        if scenario['sort_policy'] not in SORT_POLICIES:
+            raise ValueError("Unknown sort policy '" + scenario['sort_policy'] + "' in scenario '" + scenario['scenario'] + "', this should be one of " + ", ".join(SORT_POLICIES))
+        if scenario['solver'] not in ["heuristic", "flow"]:
+            raise ValueError("Unknown solver '" + scenario['solver'] + "' in scenario '" + scenario['scenario'] + "', this should be either 'heuristic' or 'flow'")
+
+    return scenarios
+
+def set_shared_scenario_data(df_charities, df_signups):
+    shared_scenario_data['df_charities'] = df_charities
+    shared_scenario_data['df_signups'] = df_signups
+
+# Places everyone for one scenario (using the preprocessed data in shared_scenario_data), and returns how well it went
+def run_scenario(scenario):
+    start_time = time.perf_counter()
+    df_charities = shared_scenario_data['df_charities'].copy()
+    df_signups = shared_scenario_data['df_signups'].copy()
+
+    # Change the numbers for this scenario. Changing the max changes the ratios too
+    df_charities['min_number'] = np.round(df_charities['min_number'] * scenario['capacity_scale']).astype(np.int64)
+    df_charities['max_number'] = np.round(df_charities['max_number'] * scenario['capacity_scale']).astype(np.int64)
+    for place_name, (min_number, max_number) in scenario['capacity_changes'].items():
+        is_place = df_charities['charity'] == place_name
+        if pd.notna(min_number):
+            df_charities.loc[is_place, 'min_number'] = int(min_number)
+        if pd.notna(max_number):
+            df_charities.loc[is_place, 'max_number'] = int(max_number)
+    df_charities['ratio'] = df_charities['total_signups'] / df_charities['max_number']
+
+    if scenario['sort_policy'] == "ratio":
+        sort_charities_by_ratio(df_charities, df_signups)
+        sort_participants_by_group_size_and_num_charities_selected(df_signups)
+    elif scenario['sort_policy'] == "signup_time":
+        sort_charities_by_ratio(df_charities, df_signups)
+        df_signups.sort_values('timestamp', kind = 'stable', inplace = True)
+        df_signups.reset_index(inplace = True, drop = True)
+
+    state = PlacementState(df_charities, df_signups)
+    ids_with_no_existing_options = state.get_ids_with_no_existing_options()
+    too_late_signups_list = place_participants(state, scenario['solver'], ids_with_no_existing_options, scenario['max_recursions'])
+
+    num_participants = int(state.group_sizes.sum())
+    num_placed_participants = int(state.participant_counts.sum())
+    return {
+        'scenario': scenario['scenario'],
+        'capacity_scale': scenario['capacity_scale'],
+        'places_changed': len(scenario['capacity_changes']),
+        'max_recursions': scenario['max_recursions'],
+        'sort_policy': scenario['sort_policy'],
+        'solver': scenario['solver'],
+        'total_min_number': int(state.min_numbers.sum()),
+        'total_max_number': int(state.max_numbers.sum()),
+        'participants': num_participants,
+        'placed_participants': num_placed_participants,
+        'fill_rate': num_placed_participants / max(num_participants, 1),
+        'unplaced_groups': len(ids_with_no_existing_options) + len(too_late_signups_list),
+        'places_under_min': int((state.participant_counts < state.min_numbers).sum()),
+        'places_over_max': int((state.participant_counts > state.max_numbers).sum()),
+        'seconds': time.perf_counter() - start_time,
+    }
+
+# Runs every scenario against the same preprocessed data, and returns the comparison table
+def run_scenarios(df_charities, df_signups, scenarios, num_workers = None):
+    from concurrent.futures import ProcessPoolExecutor
+
+    num_workers = min(num_workers or os.cpu_count() or 1, len(scenarios))
+    if num_workers <= 1:
+        set_shared_scenario_data(df_charities, df_signups)
+        results = [run_scenario(scenario) for scenario in scenarios]
+    else:
+        # Each worker gets sent the preprocessed data once when it starts, rather than once for every scenario
+        with ProcessPoolExecutor(max_workers = num_workers, initializer = set_shared_scenario_data, initargs = (df_charities, df_signups)) as executor:
+            results = list(executor.map(run_scenario, scenarios))
+
+    return pd.DataFrame(results)
+
+def run_whatif(places_filepath = PLACES_FILEPATH, signups_filepath = SIGNUPS_FILEPATH, scenarios_filepath = None, capacity_scales = None, max_recursions_list = None, sort_policies = None, solvers = None, num_workers = None, output_filepath = PATH.joinpath("whatif_comparison.csv"), use_cache = USE_CACHE):
+    # The accepted aliases still get used (so it places people the same as a normal run), but trying scenarios shouldn't change any files
+    config = GeneratorConfig(place_aliases_filepath = Path(places_filepath).parent.joinpath(PLACE_ALIASES_FILENAME), save_place_alias_suggestions = False)
+    df_charities, df_signups = prepare_scenario_data(places_filepath, signups_filepath, config, InputCache() if use_cache else None)
+    scenarios = get_scenarios(df_charities, scenarios_filepath, capacity_scales, max_recursions_list, sort_policies, solvers, config)
+    print("Running " + str(len(scenarios)) + " scenarios")
+
+    df_comparison = run_scenarios(df_charities, df_signups, scenarios, num_workers)
+    df_comparison.to_csv(output_filepath, index = False)
+
+    print(df_comparison[['scenario', 'total_max_number', 'fill_rate', 'unplaced_groups', 'places_under_min', 'places_over_max']].round(3).to_string(index = False))
+    print("\nThe full comparison has been saved to " + str(output_filepath))
+    return df_comparison
+
+
+# RUNNING CODE ----------------------------------------------------------------------------
+
+# All the settings for a run. By default they're the constants at the top of the file, but any of them can be changed when it's created,
+# eg. GeneratorConfig(solver = "flow", max_num_emails = 4)
+class GeneratorConfig:
+    def __init__(self, **settings):
+        self.solver = SOLVER
+        self.max_recursions = MAX_RECURSIONS
+        self.max_num_emails = MAX_NUM_EMAILS
+        self.resolve_place_names = RESOLVE_PLACE_NAMES
+        self.place_aliases_filepath = None # Where to read accepted aliases from and save suggestions to (None means no file)
+        self.save_place_alias_suggestions = True # False only reads the accepted aliases, without adding suggestions to the file
+        self.previous_placements_filepath = None # Only placing the new signups around the people in this previous output (None means place everyone)
+        self.optimise_seconds = OPTIMISE_SECONDS
+        self.optimise_workers = OPTIMISE_WORKERS
+        self.optimise_seed = OPTIMISE_SEED
+        self.optimise_trial = OPTIMISE_TRIAL # Use this trial's order instead of searching (None means search if optimise_seconds is more than 0)
+        self.split_into_components = SPLIT_INTO_COMPONENTS
+
+        for name, value in settings.items():
+            if not hasattr(self, name):
+                raise TypeError("Unknown setting '" + str(name) + "'")
+            setattr(self, name, value)
+
+
+# Everything between reading the inputs and sorting them. Takes the places and signups as they are in the input files (changing them in-place),
+# and returns the repeated emails
+def preprocess_inputs(df_charities, df_signups, config, report, places_filepath = PLACES_FILEPATH):
     rename_columns_and_fill_empty_ones(df_charities, df_signups)
 
     # Before sorting the signups, check for duplicated emails and note any repeated emails
-    df_repeated_emails = check_repeated_emails(df_signups)
-    remove_commas(df_charities, df_signups)
-    count_num_participants_in_group(df_signups)
-    count_charities_picked_by_group(df_signups)
-    get_charity_ratios(df_charities, df_signups)
+    with report.phase("check_repeated_emails"):
+        df_repeated_emails = check_repeated_emails(df_signups, config.max_num_emails)
+    with report.phase("preprocessing"):
+        remove_commas(df_charities, df_signups)
+        count_num_participants_in_group(df_signups, config.max_num_emails)
+        count_charities_picked_by_group(df_signups)
+        if config.resolve_place_names:
+            resolve_place_names(df_charities, df_signups, config.place_aliases_filepath, config.save_place_alias_suggestions)
+        get_charity_ratios(df_charities, df_signups, places_filepath)
+
+    return df_repeated_emails
+
+# Everything between reading the inputs and saving the outputs. Takes the places and signups as they are in the input files (changing them
+# in-place), and returns all the tables that go in the output by name. If they've already been through preprocess_inputs (eg. they came from
+# the cache), pass in the repeated emails it returned and that step gets skipped
+def process_signups(df_charities, df_signups, config, report, places_filepath = PLACES_FILEPATH, profiler = None, df_repeated_emails = None):
+    report.info['max_recursions'] = config.max_recursions
+    if df_repeated_emails is None:
+        df_repeated_emails = preprocess_inputs(df_charities, df_signups, config, report, places_filepath)
 
     # Sort our dataframes so we vaguely optimally pick who to add to each charity
-    sort_charities_by_ratio(df_charities, df_signups)
-    sort_participants_by_group_size_and_num_charities_selected(df_signups)
+    with report.phase("sort"):
+        sort_charities_by_ratio(df_charities, df_signups)
+        sort_participants_by_group_size_and_num_charities_selected(df_signups)
+
+    # Try shuffling the order around a bit to see if that places people better (not when adding to a previous output, since everyone stays put anyway)
+    if config.optimise_trial is not None and config.previous_placements_filepath is None:
+        use_placement_trial(df_charities, df_signups, config.optimise_seed, config.optimise_trial, report)
+    elif config.optimise_seconds > 0 and config.previous_placements_filepath is None:
+        with report.phase("optimise_order"):
+            optimise_placement_order(df_charities, df_signups, config.solver, config.max_recursions, config.optimise_seconds, config.optimise_workers, config.optimise_seed, report)
     
+    # If we're adding to a previous output, work out where everyone was last time
+    previous_placements = None
+    if config.previous_placements_filepath is not None:
+        if Path(config.previous_placements_filepath).exists():
+            with report.phase("read_previous_placements"):
+                previous_placements = get_previous_placements(config.previous_placements_filepath, df_charities, df_signups, config.max_num_emails)
+        else:
+            print("INCREMENTAL is on, but there's no previous output at " + str(config.previous_placements_filepath) + ", so everyone will be placed from scratch")
+            print("\n")
+
     # Go through and assign all our participants, and record the people the algorithm couldn't place
-    df_unassignable_people = assign_participants_to_charities(df_charities, df_signups)
+    with report.phase("assign_participants_to_charities"):
+        if profiler is not None:
+            profiler.enable()
+        df_unassignable_people = assign_participants_to_charities(df_charities, df_signups, config.solver, config.max_recursions, previous_placements, report, config.split_into_components, config.max_num_emails)
+        if profiler is not None:
+            profiler.disable()
+    report.record_results(df_charities, df_signups, df_unassignable_people)
+
+    df_changes = None
+    if previous_placements is not None:
+        df_changes = generate_dataframe_of_changes(df_charities, df_signups, previous_placements, config.max_num_emails)
 
     # Go through the participant ids assigned to charities, and transform them into human-readable emails. Also checks that all the assignments are valid
-    transform_participant_ids_into_emails(df_charities, df_signups)
+    with report.phase("transform_participant_ids_into_emails"):
+        transform_participant_ids_into_emails(df_charities, df_signups, report, config.max_num_emails)
 
     # Get the emails of everyone who wanted further information about one of the options
-    df_emails_for_each_club_further_info = get_further_details_email_lists(df_signups)
+    with report.phase("get_further_details_email_lists"):
+        df_emails_for_each_club_further_info = get_further_details_email_lists(df_signups, config.max_num_emails)
+
+    return {
+        'df_charities': df_charities,
+        'df_signups': df_signups,
+        'df_unassignable_people': df_unassignable_people,
+        'df_repeated_emails': df_repeated_emails,
+        'df_emails_for_each_club_further_info': df_emails_for_each_club_further_info,
+        'df_changes': df_changes,
+    }
+
+# Runs everything for one event, saving the outputs in output_path. Returns the run report
+def run_generator(places_filepath = PLACES_FILEPATH, signups_filepath = SIGNUPS_FILEPATH, output_path = PATH, previous_placements_filepath = PREVIOUS_PLACEMENTS_FILEPATH, use_cache = USE_CACHE):
+    output_path = Path(output_path)
+    config = GeneratorConfig(
+        place_aliases_filepath = Path(places_filepath).parent.joinpath(PLACE_ALIASES_FILENAME),
+        previous_placements_filepath = previous_placements_filepath if INCREMENTAL else None,
+    )
+    report = RunReport()
+    report.info['places_filepath'] = str(places_filepath)
+    report.info['signups_filepath'] = str(signups_filepath)
+
+    # Read the dataframes and preprocess them (or get them from the cache if the files haven't changed)
+    # TODO: Change to df_places for extensibility # TODO Amend so this is more extensible and expects the name "place", or just rename this column at start lols
+    df_charities, df_signups, df_repeated_emails = read_and_preprocess_inputs(places_filepath, signups_filepath, config, report, InputCache() if use_cache else None)
+
+    profiler = cProfile.Profile() if PROFILE_ASSIGNMENT else None
+    outputs = process_signups(df_charities, df_signups, config, report, places_filepath, profiler, df_repeated_emails)
 
     # Save the various dataframes
-    save_dataframes_as_excel(df_charities, df_unassignable_people, df_repeated_emails, df_emails_for_each_club_further_info)
+    with report.phase("save"):
+        save_dataframes(outputs['df_charities'], outputs['df_unassignable_people'], outputs['df_repeated_emails'], outputs['df_emails_for_each_club_further_info'], outputs['df_changes'], output_path = output_path)
+
+    if WRITE_RUN_REPORT:
+        report.save(output_path.joinpath("placements_report.json"))
+    if profiler is not None:
+        profiler.dump_stats(str(output_path.joinpath("placements_assignment.prof")))
 
     print("Program completed. You can now open the output excel. Please read output and adjust/rerun the code where necessary, in particular for unassignable people and duplicate emails")
-    input("Press enter to close program")
+    return report
 
 # Something to keep the code open in case of errors
 if __name__ == '__main__':
-    try:
-        run_generator() # The actual main function
-    except BaseException:
-        print("There has been an error. Please inform a nerd so they can figure out what it is and how to fix it lol\n")
-        import sys
-        print(sys.exc_info()[0])
-        import traceback
-        print(traceback.format_exc())
-        print("Press Enter to close (after you've found a nerd and shown them this error message so they can fix it)")
-        input() 
-
-
-
-
-
-
-
-
-
-
-
-    
-
-    
-
-    
-
+    # Running it with "batch" runs lots of events at once (see BATCH MODE above), "serve" runs it as a local service (see USING IT FROM
+    # OTHER CODE) and "whatif" tries out different capacities (see WHAT-IF SCENARIOS). Otherwise (eg. double clicking it) it just runs the one event,
+    # and "--no-cache" runs it without using the cache (see CACHING INPUTS BETWEEN RUNS)
+    if len(sys.argv) > 1 and sys.argv[1] in ["batch", "serve", "whatif"]:
+        import argparse
+        parser = argparse.ArgumentParser(description = "Places participants in groups based on their preferences")
+        subparsers = parser.add_subparsers(dest = "mode", required = True)
+
+        batch_parser = subparsers.add_parser("batch", help = "Place lots of events at once")
+        batch_parser.add_argument("batch_path", help = "A folder with a folder for each event in it, or a manifest file with event, places and signups columns")
+        batch_parser.add_argument("--workers", type = int, default = None, help = "How many events to run at once (defaults to the number of CPU cores)")
+        batch_parser.add_argument("--no-cache", action = "store_true", help = "Read and preprocess every input again, even if it hasn't changed")
+
+        serve_parser = subparsers.add_parser("serve", help = "Run a local JSON service which places signups sent to it")
+        serve_parser.add_argument("--places", default = str(PLACES_FILEPATH), help = "Places file to load when it starts")
+        serve_parser.add_argument("--host", default = "127.0.0.1")
+        serve_parser.add_argument("--port", type = int, default = 8765)
+
+        whatif_parser = subparsers.add_parser("whatif", help = "Compare how placing goes with different capacities and settings")
+        whatif_parser.add_argument("--places", default = str(PLACES_FILEPATH))
+        whatif_parser.add_argument("--signups", default = str(SIGNUPS_FILEPATH))
+        whatif_parser.add_argument("--scenarios", default = None, help = "A .csv or excel file listing the scenarios to try")
+        whatif_parser.add_argument("--capacity-scale", type = float, nargs = "+", default = None, help = "Multiply every place's min_number and max_number by each of these")
+        whatif_parser.add_argument("--max-recursions", type = int, nargs = "+", default = None)
+        whatif_parser.add_argument("--sort-policy", nargs = "+", default = None, choices = SORT_POLICIES)
+        whatif_parser.add_argument("--solver", nargs = "+", default = None, choices = ["heuristic", "flow"])
+        whatif_parser.add_argument("--workers", type = int, default = None, help = "How many scenarios to run at once (defaults to the number of CPU cores)")
+        whatif_parser.add_argument("--output", default = str(PATH.joinpath("whatif_comparison.csv")))
+        whatif_parser.add_argument("--no-cache", action = "store_true", help = "Read the inputs again, even if they haven't changed")
+
+        args = parser.parse_args()
+        if args.mode == "batch":
+            run_batch(args.batch_path, args.workers, USE_CACHE and not args.no_cache)
+        elif args.mode == "serve":
+            run_service(args.places, args.host, args.port)
+        else:
+            run_whatif(args.places, args.signups, args.scenarios, args.capacity_scale, args.max_recursions, args.sort_policy, args.solver, args.workers, args.output, USE_CACHE and not args.no_cache)
+    else:
+        try:
+            run_generator(use_cache = USE_CACHE and "--no-cache" not in sys.argv) # The actual main function
+            input("Press enter to close program")
+        except BaseException:
+            print("There has been an error. Please inform a nerd so they can figure out what it is and how to fix it lol\n")
+            print(sys.exc_info()[0])
+            import traceback
+            print(traceback.format_exc())
+            print("Press Enter to close (after you've found a nerd and shown them this error message so they can fix it)")
+            input() 
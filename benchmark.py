@@ -0,0 +1,240 @@
+# Benchmarks for the group generator, using made-up signups so we can see how it copes with big or awkward events
+# Run it with "python benchmark.py" (add --help to see the options). Each run adds its results to benchmark_results.csv, with a label
+# so you can compare runs against each other, eg. before and after changing the code:
+#     python benchmark.py --label before
+#     python benchmark.py --label after
+# With --check it doesn't time anything, and instead checks that splitting the places into separate clusters gives exactly the same placements
+# as placing everything in one go, for each scenario, solver and --check-seeds seed
+
+import argparse
+import contextlib
+import importlib
+import io
+import multiprocessing
+import re
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+PATH = Path(__file__).parent
+sys.path.insert(0, str(PATH))
+generator = importlib.import_module("Group Generator for Day of Good v2") # The name has spaces in it, so it can't be imported normally
+
+# Each scenario is the settings for generate_synthetic_event. The group size weights are how likely a group of 1, 2, 3... people is
+SCENARIOS = {
+    "small": dict(num_places = 15, num_signups = 100, group_size_weights = [5, 3, 2], max_preferences = 6, skew = 0.5, oversubscription = 0.8),
+    "medium": dict(num_places = 40, num_signups = 1000, group_size_weights = [5, 3, 2], max_preferences = 8, skew = 0.8, oversubscription = 0.9),
+    "large": dict(num_places = 150, num_signups = 10000, group_size_weights = [5, 3, 2], max_preferences = 10, skew = 0.8, oversubscription = 0.9),
+    "oversubscribed": dict(num_places = 40, num_signups = 2000, group_size_weights = [5, 3, 2], max_preferences = 6, skew = 1.0, oversubscription = 1.5),
+    "long_preference_lists": dict(num_places = 80, num_signups = 3000, group_size_weights = [5, 3, 2], max_preferences = 40, skew = 0.5, oversubscription = 0.9),
+    "big_groups": dict(num_places = 40, num_signups = 1500, group_size_weights = [1, 2, 6], max_preferences = 6, skew = 0.8, oversubscription = 1.0),
+    # Everyone wants the same few small places, which sends the heuristic's bumping all the way to MAX_RECURSIONS
+    "pathological": dict(num_places = 30, num_signups = 1500, group_size_weights = [3, 3, 3], max_preferences = 3, skew = 3.0, oversubscription = 2.0),
+    # Lots of campuses, where everyone only picks places on their own campus
+    "clustered": dict(num_places = 400, num_signups = 20000, group_size_weights = [5, 3, 2], max_preferences = 6, skew = 0.8, oversubscription = 1.1, num_clusters = 40),
+    # A few very oversubscribed campuses with mixed group sizes, which is where the flow solver used to place clusters differently on their own
+    "oversubscribed_clusters": dict(num_places = 60, num_signups = 600, group_size_weights = [5, 3, 2], max_preferences = 5, skew = 0.8, oversubscription = 1.9, num_clusters = 6),
+    # For checking memory use (with --memory). Not run unless it's asked for, since making the signups takes a while
+    "huge": dict(num_places = 1000, num_signups = 100000, group_size_weights = [5, 3, 2], max_preferences = 10, skew = 0.8, oversubscription = 0.9, num_clusters = 20),
+}
+DEFAULT_SCENARIOS = [scenario_name for scenario_name in SCENARIOS if scenario_name != "huge"]
+
+
+# Makes up a places and signups dataframe in the same format as places_input.xlsx and signups_input.xlsx
+# skew is how much more popular the popular places are (0 means everywhere is equally popular), and oversubscription is how many
+# participants there are compared to the total max_number of all the places. With more than one cluster, the places are split into that
+# many clusters (like campuses) and each signup only picks places in one of them
+def generate_synthetic_event(num_places, num_signups, group_size_weights, max_preferences, skew, oversubscription, seed = 0, unknown_option_rate = 0.01, repeated_email_rate = 0.01, num_clusters = 1):
+    rng = np.random.default_rng(seed)
+
+    # Group sizes, up to however many email columns there are
+    group_size_weights = np.array(group_size_weights[:generator.MAX_NUM_EMAILS], dtype = float)
+    group_sizes = rng.choice(np.arange(1, len(group_size_weights) + 1), size = num_signups, p = group_size_weights / group_size_weights.sum())
+
+    # Places, with some names that have commas in them like the real ones do. Capacities are split up in proportion to popularity (roughly)
+    # so the total comes out at the right amount of oversubscription
+    place_names = []
+    for i in range(num_places):
+        if i % 5 == 0:
+            place_names.append("Suburb " + str(i) + " - Mulching, weeding and painting (Charity " + str(i) + ")")
+        else:
+            place_names.append("Suburb " + str(i) + " - Volunteering (Charity " + str(i) + ")")
+    popularity = 1 / np.arange(1, num_places + 1) ** skew
+    popularity = popularity / popularity.sum()
+
+    total_capacity = group_sizes.sum() / oversubscription
+    capacity_weights = rng.uniform(0.5, 1.5, num_places)
+    max_numbers = np.maximum(generator.MAX_NUM_EMAILS, np.round(total_capacity * capacity_weights / capacity_weights.sum())).astype(np.int64)
+    min_numbers = np.maximum(1, np.round(max_numbers * rng.uniform(0.3, 0.8, num_places))).astype(np.int64)
+    df_places = pd.DataFrame({'place': place_names, 'min_number': min_numbers, 'max_number': max_numbers})
+
+    # Signups, each picking a few places (more likely to be the popular ones) in their cluster
+    num_preferences = rng.integers(1, min(max_preferences, num_places // num_clusters) + 1, size = num_signups)
+    timestamps = pd.Timestamp("2023-03-24") + pd.to_timedelta(np.sort(rng.integers(0, 14 * 24 * 3600, size = num_signups)), unit = 's')
+    place_clusters = np.arange(num_places) % num_clusters
+    if num_clusters > 1: # Only using up random numbers when there are clusters, so the other scenarios stay the same as they've always been
+        cluster_popularity = np.bincount(place_clusters, weights = popularity, minlength = num_clusters)
+        signup_clusters = rng.choice(num_clusters, size = num_signups, p = cluster_popularity / cluster_popularity.sum())
+    rows = []
+    for i in range(num_signups):
+        emails = ["person" + str(i) + "_" + str(j) + "@example.com" for j in range(group_sizes[i])]
+        if i > 0 and rng.random() < repeated_email_rate:
+            emails[0] = "person" + str(i - 1) + "_0@example.com"
+        emails = emails + [np.nan] * (generator.MAX_NUM_EMAILS - len(emails))
+
+        if num_clusters > 1:
+            cluster_place_ids = np.flatnonzero(place_clusters == signup_clusters[i])
+            chosen_place_ids = rng.choice(cluster_place_ids, size = num_preferences[i], replace = False, p = popularity[cluster_place_ids] / popularity[cluster_place_ids].sum())
+        else:
+            chosen_place_ids = rng.choice(num_places, size = num_preferences[i], replace = False, p = popularity)
+        chosen_places = [place_names[p] for p in chosen_place_ids]
+        if rng.random() < unknown_option_rate:
+            chosen_places.append("An option which got renamed")
+
+        row = {'timestamp': timestamps[i], 'names': "Person " + str(i)}
+        for col_name, email in zip(generator.get_email_col_names(), emails):
+            row[col_name] = email
+        row['preferenced_options'] = ", ".join(chosen_places)
+        row['further_details'] = ", ".join(rng.choice(["Club A", "Club B", "Club C"], size = rng.integers(0, 3), replace = False)) or np.nan
+        rows.append(row)
+
+    return df_places, pd.DataFrame(rows)
+
+
+# Runs the same steps as run_generator (apart from reading and saving the files), and returns how long each took and how well it went
+def run_pipeline(df_places, df_signups, solver):
+    df_charities = df_places.copy()
+    df_signups = df_signups.copy()
+    report = generator.RunReport()
+    config = generator.GeneratorConfig(solver = solver, optimise_seconds = 0)
+
+    with contextlib.redirect_stdout(io.StringIO()): # The generator prints a lot, which we don't care about here
+        outputs = generator.process_signups(df_charities, df_signups, config, report)
+    df_signups = outputs['df_signups']
+
+    results = {"phase_" + name + "_s": seconds for name, seconds in report.phase_seconds.items()}
+    results["total_s"] = sum(report.phase_seconds.values())
+    results["participants"] = report.info['num_participants']
+    results["placed_participants"] = report.info['num_placed_participants']
+    results["fill_rate"] = report.info['fill_rate']
+    results["unplaced_groups"] = report.info['num_unplaced_groups']
+    results["places_under_min"] = report.info['num_places_under_min']
+    results["places_over_max"] = report.info['num_places_over_max']
+    results["max_bumps_by_one_group"] = int(df_signups['num_bumps_caused'].max()) if len(df_signups) > 0 else 0
+    for name in ["direct_placements", "bumps", "max_recursion_depth", "max_recursions_reached", "bump_cycles_detected", "find_and_replace_latest_signups_fallbacks"]:
+        results[name] = report.counters[name]
+    if 'components' in report.info:
+        results["components"] = report.info['components']['num_components']
+        results["largest_component_signups"] = report.info['components']['largest_component_signups']
+    return results
+
+
+# Runs the pipeline on the event saved in event_filepath and also records the peak memory (RSS) of the process, so this should be run in a
+# fresh process each time (see run_benchmarks). input_peak_rss_mb is the peak just from loading the inputs, so peak_rss_mb - input_peak_rss_mb
+# is roughly how much extra the generator needed
+def run_pipeline_measuring_memory(event_filepath, solver):
+    import resource # Not on Windows, so only imported when measuring memory
+
+    df_places, df_signups = pd.read_pickle(event_filepath)
+    input_peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results = run_pipeline(df_places, df_signups, solver)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    rss_units_per_mb = 1024 * 1024 if sys.platform == "darwin" else 1024 # macOS gives bytes, Linux gives kilobytes
+    results["input_peak_rss_mb"] = input_peak_rss / rss_units_per_mb
+    results["peak_rss_mb"] = peak_rss / rss_units_per_mb
+    results["pipeline_rss_mb"] = (peak_rss - input_peak_rss) / rss_units_per_mb
+    return results
+
+def run_benchmarks(scenario_names, solvers, seed, repeats, label, measure_memory = False):
+    all_results = []
+    for scenario_name in scenario_names:
+        df_places, df_signups = generate_synthetic_event(seed = seed, **SCENARIOS[scenario_name])
+        if measure_memory:
+            event_file = tempfile.NamedTemporaryFile(suffix = ".pkl", delete = False)
+            event_file.close()
+            pd.to_pickle((df_places, df_signups), event_file.name)
+
+        for solver in solvers:
+            for repeat in range(repeats):
+                results = {"label": label, "scenario": scenario_name, "solver": solver, "seed": seed, "repeat": repeat, "places": len(df_places), "signups": len(df_signups)}
+                if measure_memory:
+                    # A brand new process each time, so the peak memory is just from this run
+                    with ProcessPoolExecutor(max_workers = 1, mp_context = multiprocessing.get_context("spawn")) as executor:
+                        results.update(executor.submit(run_pipeline_measuring_memory, event_file.name, solver).result())
+                else:
+                    results.update(run_pipeline(df_places, df_signups, solver))
+                all_results.append(results)
+                print(scenario_name + " (" + solver + "): " + str(round(results["total_s"], 3)) + "s, filled " + str(round(100 * results["fill_rate"], 1)) + "%, " + str(results["unplaced_groups"]) + " unplaced groups" + (", peak memory " + str(round(results["peak_rss_mb"])) + "MB" if measure_memory else ""))
+
+        if measure_memory:
+            Path(event_file.name).unlink()
+    return pd.DataFrame(all_results)
+
+# Places each made-up event with and without splitting it into clusters, and checks the placements, the unassignable people and the messages
+# all come out the same. Returns the cases which didn't match
+def check_split_matches_whole(scenario_names, solvers, seeds):
+    mismatches = []
+    num_cases = 0
+    for scenario_name in scenario_names:
+        for seed in seeds:
+            df_places, df_signups = generate_synthetic_event(seed = seed, **SCENARIOS[scenario_name])
+            for solver in solvers:
+                whole = generator.generate_placements(df_places, df_signups, generator.GeneratorConfig(solver = solver, optimise_seconds = 0, split_into_components = False))
+                split = generator.generate_placements(df_places, df_signups, generator.GeneratorConfig(solver = solver, optimise_seconds = 0, split_into_components = True))
+                num_cases += 1
+
+                different = [name for name in ['placements', 'unassignable'] if not whole[name].reset_index(drop = True).equals(split[name].reset_index(drop = True))]
+                if get_comparable_messages(whole['messages']) != get_comparable_messages(split['messages']):
+                    different.append('messages')
+                if len(different) > 0:
+                    mismatches.append({"scenario": scenario_name, "solver": solver, "seed": seed, "different": ", ".join(different)})
+                print(scenario_name + " (" + solver + ", seed " + str(seed) + "): " + ("DIFFERENT " + ", ".join(different) if len(different) > 0 else "same"))
+
+    print("\n" + str(num_cases - len(mismatches)) + " of " + str(num_cases) + " cases came out the same split up as placed in one go")
+    return pd.DataFrame(mismatches)
+
+# The timings and the line about how many clusters there are are always different, so they're taken out
+def get_comparable_messages(messages):
+    lines = [line for line in messages.split("\n") if not line.startswith("The signups split up into ")]
+    return [re.sub(r"[0-9.]+ seconds", "", line) for line in lines]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Times the group generator on made-up events")
+    parser.add_argument("--scenarios", nargs = "+", default = DEFAULT_SCENARIOS, choices = list(SCENARIOS))
+    parser.add_argument("--solvers", nargs = "+", default = ["heuristic", "flow"], choices = ["heuristic", "flow"])
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--repeats", type = int, default = 1, help = "How many times to run each scenario (the made-up data is the same each time)")
+    parser.add_argument("--label", default = time.strftime("%Y-%m-%d %H:%M"), help = "Name for this run in the results file, eg. the branch you're on")
+    parser.add_argument("--output", default = str(PATH.joinpath("benchmark_results.csv")), help = "CSV to add the results to")
+    parser.add_argument("--memory", action = "store_true", help = "Also record the peak memory use, running each scenario in its own process (not on Windows)")
+    parser.add_argument("--check", action = "store_true", help = "Check splitting into clusters places everyone the same as placing them all at once, instead of timing anything")
+    parser.add_argument("--check-seeds", type = int, nargs = "+", default = [0, 1, 2, 3], help = "Which made-up events to check each scenario with")
+    args = parser.parse_args()
+
+    if args.check:
+        df_mismatches = check_split_matches_whole(args.scenarios, args.solvers, args.check_seeds)
+        if len(df_mismatches) > 0:
+            print(df_mismatches.to_string(index = False))
+        sys.exit(1 if len(df_mismatches) > 0 else 0)
+
+    df_results = run_benchmarks(args.scenarios, args.solvers, args.seed, args.repeats, args.label, args.memory)
+
+    # Add to the results from previous runs so they can be compared
+    output_path = Path(args.output)
+    if output_path.exists():
+        df_results = pd.concat([pd.read_csv(output_path), df_results], ignore_index = True)
+    df_results.to_csv(output_path, index = False)
+
+    print("\n")
+    summary_col_names = ['total_s', 'phase_assign_participants_to_charities_s', 'fill_rate', 'unplaced_groups', 'places_under_min', 'places_over_max']
+    if args.memory:
+        summary_col_names = summary_col_names + ['peak_rss_mb', 'pipeline_rss_mb']
+    print(df_results[df_results['label'] == args.label].groupby(['scenario', 'solver'])[summary_col_names].mean().round(3).to_string())
+    print("\nResults saved to " + str(output_path))